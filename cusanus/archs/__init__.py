@@ -2,6 +2,11 @@ from . siren import (ImplicitNeuralModule,
                      LatentModulation,
                      SirenNet,
                      ModulatedSirenNet,
+                     StackedSirenNet,
+                     StackedModulatedSirenNet,
                      Sine)
 from . gmodule import GModule
 from . kmodule import KModule, EModule
+from . quantization import (QuantizedLinear, quantize_module,
+                             quantize_field)
+from . precision import Float32Linear, fp32_first_layers
@@ -1,23 +1,60 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from functorch import vmap
+from typing import NamedTuple
 
 from cusanus.pytypes import *
 
 
-class PhysObj(nn.Module):
+class ObjState(NamedTuple):
+    """States of a batch of objects as contiguous arrays
+
+    A pytree, so it passes through `vmap` and autograd like any
+    tuple of tensors.
+    """
+    g: Tensor # objects x gdim
+    k: Tensor # objects x kdim
+    t: Tensor # objects x 1
+
+    @property
+    def nobjects(self):
+        return self.g.shape[0]
+
+    def select(self, idx:Tensor):
+        """States of the objects at `idx`"""
+        return ObjState(self.g[idx], self.k[idx], self.t[idx])
+
+
+class ModulatedMLP(nn.Module):
+    """Small modulated network, `(queries, code) -> outputs`
+
+    The code is appended to every query row. Used for the event
+    heads, whose queries are object encodings rather than
+    coordinates (so no Siren).
+    """
+
+    def __init__(self, q_in:int, out:int, mod:int, hidden:int = 64,
+                 layers:int = 2, sigmoid:bool = False):
+        super().__init__()
+        dims = [q_in + mod] + [hidden] * layers
+        blocks = []
+        for (a, b) in zip(dims[:-1], dims[1:]):
+            blocks += [nn.Linear(a, b), nn.ReLU()]
+        blocks.append(nn.Linear(dims[-1], out))
+        if sigmoid:
+            blocks.append(nn.Sigmoid())
+        self.net = nn.Sequential(*blocks)
+
+    def forward(self, q:Tensor, m:Tensor):
+        m = m.expand(*q.shape[:-1], m.shape[-1])
+        return self.net(torch.cat([q, m], dim = -1))
 
-    def __init__(self,
-                 g: Tensor,
-                 k: Tensor,
-                 t: Tensor):
-        self.register_buffer('g', g)
-        self.register_buffer('k', k)
-        self.register_buffer('t', t)
 
 class PhysObjEncoder(nn.Module):
 
     def __init__(self, gsize:int, ksize:int, hidden:int):
+        super().__init__()
         self.g_enc = nn.Sequential(
             nn.Linear(gsize, hidden),
             nn.ReLU())
@@ -27,48 +64,91 @@ class PhysObjEncoder(nn.Module):
         self.hidden = nn.Sequential(
             nn.Linear(hidden * 2, hidden))
 
-    def forward(self, obj:PhysObj):
+    def forward(self, obj:ObjState):
         genc = self.g_enc(obj.g)
-        kenc = self.k_enc(torch.cat([obj.k, obj.t]))
-        return self.hidden(torch.cat([genc, kenc]))
+        kenc = self.k_enc(torch.cat([obj.k, obj.t], dim = -1))
+        return self.hidden(torch.cat([genc, kenc], dim = -1))
 
 
 class UpdateModule(nn.Module):
 
     def __init__(self, gsize:int, ksize:int, obj_hidden:int,
                  fdim:int, ddim:int, inr_params:dict) -> None:
+        super().__init__()
         self.object_enc = PhysObjEncoder(gsize, ksize, obj_hidden)
-        self.inr = ImplicitNeuralModule(q_in = obj_hidden,
-                                        out = ksize,
-                                        mod = fdim + ddim,
-                                        **inr_params)
+        self.inr = ModulatedMLP(q_in = obj_hidden,
+                                out = ksize,
+                                mod = fdim + ddim,
+                                **inr_params)
 
-    def forward(self, obj:PhysObj, fmod, dmod):
-        q = self.obj_enc(obj)
-        new_k = self.inr(q, torch.cat(fmod, dmod))
-        return PhysObj(obj.g, new_k, torch.zeros_like(obj.t))
+    def forward(self, obj:ObjState, fmod:Tensor, dmod:Tensor):
+        """Updates the kinematic state of every object in `obj`"""
+        q = self.object_enc(obj)
+        mods = torch.cat([fmod, dmod], dim = -1)
+        # one query and modulation per object
+        new_k = vmap(self.inr)(q.unsqueeze(1), mods).squeeze(1)
+        return obj._replace(k = new_k, t = torch.zeros_like(obj.t))
 
 
 
 class EventModule(nn.Module):
 
     def __init__(self,
+                 q_params:dict,
                  c_params:dict,
                  f_params:dict,
-                 u_params:dict):
+                 u_params:dict = None):
 
+        super().__init__()
         self.Q = PhysObjEncoder(**q_params)
-        self.C = ImplicitNeuralModule(**c_params)
-        self.F = ImplicitNeuralModule(**f_params)
+        # event probability
+        self.C = ModulatedMLP(**c_params, sigmoid = True)
+        self.F = ModulatedMLP(**f_params)
 
-    def encode_obj(self, obj:PhysObj) -> Tensor:
+    def encode_obj(self, obj:ObjState) -> Tensor:
         return self.Q(obj)
 
-    def forward(self, a:PhysObj, b:PhysObj, emod, amod, bmod):
+    def events(self, query:Tensor, emod, amod, bmod):
+        # one query and modulation per pair
+        query = query.unsqueeze(1)
+        pval = vmap(self.C)(query, emod).squeeze(1)
+        fmod = vmap(self.F)(query, torch.cat([emod, amod, bmod],
+                                             dim = -1)).squeeze(1)
+        return pval, fmod
 
+    def forward(self, a:ObjState, b:ObjState, emod, amod, bmod):
+        """Event probability and force for a batch of pairs (a, b)"""
         query = torch.cat([self.encode_obj(a),
-                           self.encode_obj(b)])
-
-        pval = self.C(query, emod)
-        fmod = self.F(query, torch.cat([emod, amod, bmod]))
-        return pval, fmod
+                           self.encode_obj(b)], dim = -1)
+        return self.events(query, emod, amod, bmod)
+
+    def pair_events(self, objects:ObjState, pairs:Tensor, emods:Tensor,
+                    dmods:Tensor):
+        """Events for `pairs` (pairs x 2) of object indices
+
+        Each object is encoded once and its encoding gathered for
+        every pair it takes part in (see `check_pair_events`).
+        """
+        (a, b) = pairs[:, 0], pairs[:, 1]
+        enc = self.encode_obj(objects)
+        query = torch.cat([enc[a], enc[b]], dim = -1)
+        return self.events(query, emods, dmods[a], dmods[b])
+
+
+@torch.no_grad()
+def check_pair_events(module:EventModule, objects:ObjState, pairs:Tensor,
+                      emods:Tensor, dmods:Tensor, atol:float = 1e-5):
+    """Checks `pair_events` against encoding each pair separately
+
+    A debugging aid for a single (unbatched) sequence; call it
+    outside of `vmap` / `grad`. Raises `ValueError` on mismatch.
+    """
+    (a, b) = pairs[:, 0], pairs[:, 1]
+    out = module.pair_events(objects, pairs, emods, dmods)
+    ref = module(objects.select(a), objects.select(b),
+                 emods, dmods[a], dmods[b])
+    for (name, x, y) in zip(['pval', 'fmod'], out, ref):
+        err = torch.max(torch.abs(x - y)).item()
+        if err > atol:
+            raise ValueError(f'cached encodings differ from per-pair '
+                             f'encodings in {name} (max error {err:.2e})')
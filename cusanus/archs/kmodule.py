@@ -1,20 +1,31 @@
 import torch
 from torch import nn
 from functorch import vmap
+from contextlib import contextmanager
 
 from cusanus.pytypes import *
 from cusanus.archs import ImplicitNeuralModule
 
 class KModule(nn.Module):
+    """Kinematic field
+
+    Queries are (t, x, y) rows. Consecutive blocks of `k_per_frame`
+    rows are assumed to share the same time, so the motion field
+    and the positional modulator run once per block. `frame_size`
+    checks that assumption for a batch of queries (`KField` applies
+    it to every batch).
+    """
 
     def __init__(self,
                  mdim:int,
                  pdim:int,
                  pf_params:dict,
-                 mf_params:dict):
+                 mf_params:dict,
+                 k_per_frame:int = 1):
 
         super().__init__()
         self.mod = mdim
+        self.k_per_frame = k_per_frame
         self.pos_field = ImplicitNeuralModule(q_in = 2,
                                               out = 1,
                                               mod = pdim,
@@ -28,13 +39,41 @@ class KModule(nn.Module):
                                                  **mf_params)
         self.act = nn.Softplus()
 
+    @contextmanager
+    def frames(self, k_per_frame:int):
+        """Temporarily changes the number of queries per time"""
+        k = self.k_per_frame
+        self.k_per_frame = k_per_frame
+        try:
+            yield self
+        finally:
+            self.k_per_frame = k
+
+    def frame_size(self, qs:Tensor) -> int:
+        """`k_per_frame` if every block of `qs` (... x b x 3) shares
+        its time, otherwise 1 (one time per query)
+
+        Reads the result on the host, so call it outside of `vmap`.
+        """
+        k = self.k_per_frame
+        t = qs[..., 0]
+        if k == 1 or t.shape[-1] % k:
+            return 1
+        t = t.reshape(*t.shape[:-1], -1, k)
+        return k if bool(torch.all(t == t[..., :1])) else 1
+
     def forward(self, qs:Tensor, m:Tensor):
         b, _ = qs.shape
-        t = qs[:, 0].unsqueeze(1)    # b x 1
+        # queries that do not split into frames take one time each
+        k = self.k_per_frame if b % self.k_per_frame == 0 else 1
+        t = qs[::k, 0].unsqueeze(1)    # f x 1
         x = qs[:, 1:] # b x 2
         # pmod <- motion_field(t | motion_code)
-        pmods = self.motion_field(t, m) # b x pdim
-        ys = vmap(self.pos_field)(x, pmods) # b x 1
+        pmods = self.motion_field(t, m) # f x pdim
+        # positional modulations once per frame, shared by its queries
+        phi = vmap(self.pos_field.psi)(pmods)
+        phi = [p.repeat_interleave(k, dim = 0) for p in phi]
+        ys = vmap(self.pos_field.theta)(x, phi) # b x 1
         ys = self.act(ys)
         return ys
 
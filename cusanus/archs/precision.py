@@ -0,0 +1,49 @@
+import torch
+from torch import nn
+
+
+class Float32Linear(nn.Linear):
+    """`nn.Linear` that stays in float32 under autocast"""
+
+    def forward(self, x):
+        with torch.autocast(x.device.type, enabled = False):
+            return super().forward(x.float())
+
+
+def _first_linear(parent:nn.Module):
+    """(parent, name) of the first `nn.Linear` below `parent`"""
+    for name, child in parent.named_children():
+        if isinstance(child, nn.Linear):
+            return parent, name
+        found = _first_linear(child)
+        if not found is None:
+            return found
+    return None
+
+def fp32_first_layers(module:nn.Module):
+    """Runs the first layer of every Siren in `module` in float32
+
+    The first layer's argument `w0 * (Wx + b)` is scaled by a large
+    `w0_initial`, so rounding it to bfloat16 shifts the phase of
+    the sine. Its `nn.Linear` is replaced in place by a
+    `Float32Linear` sharing the same parameters (the state dict is
+    unchanged). The sine and `w0` product that follow are not
+    autocast ops and stay in float32.
+    """
+    for m in list(module.modules()):
+        if not (hasattr(m, 'layers') and hasattr(m, 'last_layer')):
+            continue
+        found = _first_linear(m.layers[0])
+        if found is None:
+            continue
+        parent, name = found
+        old = getattr(parent, name)
+        if isinstance(old, Float32Linear):
+            continue
+        new = Float32Linear(old.in_features, old.out_features,
+                            bias = not old.bias is None,
+                            device = 'meta')
+        new.weight = old.weight
+        new.bias = old.bias
+        setattr(parent, name, new)
+    return module
@@ -0,0 +1,108 @@
+import copy
+import torch
+from torch import nn
+
+
+class Int8Linear(torch.autograd.Function):
+    """Dynamic int8 linear layer that stays differentiable
+
+    The forward runs the quantized kernel (int8 weights, activations
+    quantized on the fly). The backward uses the dequantized weights,
+    so modulations can still be fit through quantized layers.
+    """
+
+    @staticmethod
+    def forward(x, packed, weight):
+        return torch.ops.quantized.linear_dynamic(x, packed)
+
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        (_, _, weight) = inputs
+        ctx.save_for_backward(weight)
+
+    @staticmethod
+    def backward(ctx, grad):
+        (weight,) = ctx.saved_tensors
+        return grad @ weight, None, None
+
+    @staticmethod
+    def vmap(info, in_dims, x, packed, weight):
+        assert in_dims[2] is None, 'weights cannot be batched'
+        if in_dims[0] is None:
+            # nothing batched, the output is shared across the batch
+            return Int8Linear.apply(x, packed, weight), None
+        x = x.movedim(in_dims[0], 0)
+        y = Int8Linear.apply(x.reshape(-1, x.shape[-1]), packed, weight)
+        return y.reshape(*x.shape[:-1], -1), 0
+
+
+class QuantizedLinear(nn.Module):
+    """`nn.Linear` with per-channel int8 weights"""
+
+    def __init__(self, linear:nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        w = linear.weight.detach().float()
+        scales = (w.abs().amax(dim = 1) / 127.).clamp_min(1e-8)
+        zeros = torch.zeros(len(w), dtype = torch.long)
+        qw = torch.quantize_per_channel(w, scales.double(), zeros,
+                                        axis = 0, dtype = torch.qint8)
+        bias = None if linear.bias is None else linear.bias.detach().float()
+        self.packed = torch.ops.quantized.linear_prepack(qw, bias)
+        self.register_buffer('weight', qw.dequantize())
+
+    def forward(self, x):
+        shape = x.shape
+        y = Int8Linear.apply(x.float().reshape(-1, shape[-1]),
+                             self.packed, self.weight)
+        return y.reshape(*shape[:-1], self.out_features)
+
+
+def float_layers(module:nn.Module):
+    """Linear layers kept in float: the first and last of each Siren
+
+    The first layer's inputs are scaled by a large `w0_initial` and
+    the last one produces the field output, so both are sensitive
+    to quantization error.
+    """
+    keep = set()
+    for m in module.modules():
+        if not (hasattr(m, 'layers') and hasattr(m, 'last_layer')):
+            continue
+        first = [l for l in m.layers[0].modules()
+                 if isinstance(l, nn.Linear)]
+        last = [l for l in m.last_layer.modules()
+                if isinstance(l, nn.Linear)]
+        keep.update(id(l) for l in first[:1] + last)
+    return keep
+
+def quantize_module(module:nn.Module):
+    """Int8 copy of an `ImplicitNeuralModule`, `GModule` or `KModule`
+
+    Every `nn.Linear` outside of `float_layers` is replaced with a
+    `QuantizedLinear`. The original module is left untouched.
+    """
+    module = copy.deepcopy(module)
+    keep = float_layers(module)
+
+    def replace(parent):
+        for name, child in parent.named_children():
+            if isinstance(child, nn.Linear) and not id(child) in keep:
+                setattr(parent, name, QuantizedLinear(child))
+            else:
+                replace(child)
+
+    replace(module)
+    return module.eval()
+
+def quantize_field(exp):
+    """Copy of an `ImplicitNeuralField` with a quantized module"""
+    module = exp.module
+    exp.module = None
+    try:
+        qexp = copy.deepcopy(exp)
+    finally:
+        exp.module = module
+    qexp.module = quantize_module(module)
+    return qexp
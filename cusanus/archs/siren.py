@@ -4,6 +4,7 @@ import equinox as eqx
 import jax
 import jax.numpy as jnp
 import jax.random as jr
+from jax import Array
 
 
 class Sine(eqx.Module):
@@ -18,27 +19,54 @@ class Sine(eqx.Module):
 
 class Siren(eqx.Module):
     linear: eqx.nn.Linear
-    bias: Array
+    activation: Sine
+    full_precision: bool = eqx.field(static=True)
 
-    def __init__(self, dim_in:int, dim_out:int,
-                 w0:float = 1., w_std:float = 1.,
-                 bias = True, activation = True):
+    def __init__(self,
+                 key: jax.random.key,
+                 in_features:int,
+                 out_features:int,
+                 sine_weight:float = 1.,
+                 w_std:float = 1.,
+                 use_bias:bool = True,
+                 full_precision:bool = False):
         super().__init__()
-        self.linear = nn.Linear(dim_in, dim_out, bias = bias)
+        self.full_precision = full_precision
+        key, wkey, bkey = jr.split(key, 3)
+        linear = eqx.nn.Linear(in_features, out_features,
+                               use_bias = use_bias, key = key)
         # REVIEW
         # Initialization is important
-        nn.init.uniform_(self.linear.weight, a = -w_std, b = w_std)
-        if bias:
-            nn.init.uniform_(self.linear.bias, a = -w_std, b = w_std)
-        # REVIEW: get rid of conditional?
-        self.activation = Sine(w0) if activation else nn.Identity()
+        weight = jr.uniform(wkey, linear.weight.shape,
+                            minval = -w_std, maxval = w_std)
+        linear = eqx.tree_at(lambda l: l.weight, linear, weight)
+        if use_bias:
+            bias = jr.uniform(bkey, linear.bias.shape,
+                              minval = -w_std, maxval = w_std)
+            linear = eqx.tree_at(lambda l: l.bias, linear, bias)
+        self.linear = linear
+        self.activation = Sine(sine_weight)
 
     def __call__(self, x):
-        x =  self.linear(x)
-        y = Sine(self.sine_weight)(x)
+        if self.full_precision:
+            # the first layer's argument is scaled by w0_initial, so
+            # it is computed in float32 whatever the input and weights
+            dtype = x.dtype
+            f32 = lambda a: a.astype(jnp.float32) if eqx.is_array(a) else a
+            linear = jax.tree_util.tree_map(f32, self.linear)
+            return self.activation(linear(f32(x))).astype(dtype)
+        x = self.linear(x)
+        y = self.activation(x)
         return y
 
 
+def checkpointed(layer: eqx.Module, *args):
+    '''Calls `layer`, recomputing its activations on the backward pass.'''
+    params, static = eqx.partition(layer, eqx.is_array)
+    f = lambda p, *a: eqx.combine(p, static)(*a)
+    return jax.checkpoint(f)(params, *args)
+
+
 class SirenNet(eqx.Module):
     '''SirenNet model.
 
@@ -52,6 +80,9 @@ class SirenNet(eqx.Module):
         c:
         use_bias: Flag for using biases or not.
         final_activation: Activation function of final layer.
+        checkpoint_layers: Indices of layers whose activations are
+            recomputed during the backward pass. Only applies to JAX
+            training (`JaxNeuralField`), not the torch field tasks.
     '''
     in_features: int
     hidden_features: int
@@ -60,6 +91,7 @@ class SirenNet(eqx.Module):
     layers: list
     last_layer: eqx.Module
     final_activation: callable
+    checkpoint_layers: tuple = eqx.field(static=True)
 
     def __init__(self,
                  key: jax.random.key,
@@ -71,9 +103,11 @@ class SirenNet(eqx.Module):
                  sine_weight_initial: float = 15.0,
                  c: float = 6.0,
                  use_bias: bool = True,
-                 final_activation = jax.nn.sigmoid) -> None:
+                 final_activation = jax.nn.sigmoid,
+                 checkpoint_layers: tuple = ()) -> None:
         super().__init__()
         self.num_layers = num_layers
+        self.checkpoint_layers = tuple(checkpoint_layers)
         self.in_features = in_features
         self.hidden_features = hidden_features
         self.out_features = out_features
@@ -90,6 +124,7 @@ class SirenNet(eqx.Module):
                     sine_weight=sine_weight_initial if l == 0 else sine_weight,
                     w_std=1.0 / in_features if l == 0 else w_std,
                     use_bias=use_bias,
+                    full_precision=l == 0,
                 )
             )
         self.layers = layers
@@ -107,11 +142,16 @@ class SirenNet(eqx.Module):
             y: Model output.
         '''
         for l in range(self.num_layers - 1):
-            x = self.layers[l](x)
+            x = self.call_layer(l, x)
         y = self.last_layer(x)
         y = self.final_activation(y)
         return y
 
+    def call_layer(self, l:int, x:Array):
+        if l in self.checkpoint_layers:
+            return checkpointed(self.layers[l], x)
+        return self.layers[l](x)
+
 
 class ModulatedSirenNet(SirenNet):
     '''Class for modulated SirenNet.
@@ -139,7 +179,116 @@ class ModulatedSirenNet(SirenNet):
         '''
         for l in range(self.num_layers - 1):
             phi_ = phi[l]
-            x = self.layers[l](x) + phi_
+            x = self.call_layer(l, x) + phi_
+        y = self.last_layer(x)
+        y = self.final_activation(y)
+        return y
+    # pylint: enable=arguments-differ
+
+
+class StackedSirenNet(eqx.Module):
+    '''SirenNet with the hidden layers stacked into single arrays.
+
+    The identical hidden layers are applied with `lax.scan`, so the
+    traced program does not grow with depth.
+
+    Args:
+        in_features: Input size.
+        hidden_features: Hidden layer size.
+        out_features: Output layer size.
+        num_layers: Number of layers (at least 3).
+        sine_weight: Sine activation weight for hidden layers.
+        sine_weight_initial: Sine activation weight for first layer.
+        c:
+        use_bias: Flag for using biases or not.
+        final_activation: Activation function of final layer.
+        checkpoint_hidden: Recompute hidden layer activations during
+            the backward pass.
+    '''
+    in_features: int
+    hidden_features: int
+    out_features: int
+    num_layers: int
+    first_layer: Siren
+    hidden_layers: Siren
+    last_layer: eqx.Module
+    final_activation: callable
+    checkpoint_hidden: bool = eqx.field(static=True)
+
+    def __init__(self,
+                 key: jax.random.key,
+                 in_features: int,
+                 hidden_features: int,
+                 out_features: int,
+                 num_layers: int,
+                 sine_weight: float = 1.0,
+                 sine_weight_initial: float = 15.0,
+                 c: float = 6.0,
+                 use_bias: bool = True,
+                 final_activation = jax.nn.sigmoid,
+                 checkpoint_hidden: bool = False) -> None:
+        super().__init__()
+        assert num_layers >= 3, 'stacking needs at least one hidden layer'
+        self.num_layers = num_layers
+        self.checkpoint_hidden = checkpoint_hidden
+        self.in_features = in_features
+        self.hidden_features = hidden_features
+        self.out_features = out_features
+        self.final_activation = final_activation
+        w_std = jnp.sqrt(c / hidden_features) / sine_weight
+        key, fkey, hkey, lkey = jax.random.split(key, 4)
+        self.first_layer = Siren(key=fkey,
+                                 in_features=in_features,
+                                 out_features=hidden_features,
+                                 sine_weight=sine_weight_initial,
+                                 w_std=1.0 / in_features,
+                                 use_bias=use_bias,
+                                 full_precision=True)
+        make_hidden = lambda k: Siren(key=k,
+                                      in_features=hidden_features,
+                                      out_features=hidden_features,
+                                      sine_weight=sine_weight,
+                                      w_std=w_std,
+                                      use_bias=use_bias)
+        hkeys = jax.random.split(hkey, num_layers - 2)
+        self.hidden_layers = eqx.filter_vmap(make_hidden)(hkeys)
+        self.last_layer = eqx.nn.Linear(
+            key=lkey, in_features=hidden_features, out_features=out_features)
+
+    def scan_hidden(self, x: Array, phi: Array = None):
+        '''Applies the stacked hidden layers, adding `phi[l]` if given.'''
+        params, static = eqx.partition(self.hidden_layers, eqx.is_array)
+
+        def step(x, layer):
+            (p, phi_) = layer
+            y = eqx.combine(p, static)(x)
+            return (y if phi_ is None else y + phi_), None
+
+        if self.checkpoint_hidden:
+            step = jax.checkpoint(step)
+        x, _ = jax.lax.scan(step, x, (params, phi))
+        return x
+
+    def __call__(self, x: Array):
+        x = self.first_layer(x)
+        x = self.scan_hidden(x)
+        y = self.last_layer(x)
+        y = self.final_activation(y)
+        return y
+
+
+class StackedModulatedSirenNet(StackedSirenNet):
+    '''Modulated StackedSirenNet.
+
+    `phi` holds one shift per non-final layer, either as the list
+    returned by `Modulator` or stacked as a `(layers, hidden)` array.
+    '''
+
+    # pylint: disable=arguments-differ
+    def __call__(self, x:Array, phi:Array):
+        phi = jnp.stack(phi)
+        x = self.first_layer(x) + phi[0]
+        x = self.scan_hidden(x, phi[1:])
         y = self.last_layer(x)
         y = self.final_activation(y)
         return y
@@ -222,6 +371,10 @@ class Modulator(eqx.Module):
         hiddens.append(y)
         return hiddens
 
+    def stacked(self, x):
+        '''Modulations as a `(layers, hidden)` array.'''
+        return jnp.stack(self(x))
+
 
 class ImplicitNeuralModule(eqx.Module):
     '''Implicit Neural Module
@@ -232,10 +385,12 @@ class ImplicitNeuralModule(eqx.Module):
     '''
     hidden_features: int
     mod: int
-    theta: ModulatedSirenNet
+    theta: ModulatedSirenNet | StackedModulatedSirenNet
     psi: Modulator
 
-    def __init__(self, theta: ModulatedSirenNet, psi: Modulator) -> None:
+    def __init__(self,
+                 theta: ModulatedSirenNet | StackedModulatedSirenNet,
+                 psi: Modulator) -> None:
         super().__init__()
         # Siren Network - weights refered to as `theta`
         # optimized during outer loop
@@ -1,8 +1,10 @@
 from .sized import SizedDataset, write_ffcv, load_ffcv
 from .hdf5 import H5Dataset, write_to_hdf5
-from .utils import RunningStats
-from .physics import SceneDataset, SimDataset
+from .utils import RunningStats, sample_boundary
+from .physics import (SceneDataset, SimDataset, object_onsets,
+                      event_pairs)
 from .field import FieldDataset
+from .scenes import pad_scenes, BucketBatchSampler, scene_loader
 from .gfield import (ShapeDataset,
                      GFieldDataset)
 from .kfield import (KFieldDataset,
@@ -3,7 +3,8 @@ import numpy as np
 from torch.utils.data import Dataset
 
 from cusanus.pytypes import *
-from cusanus.datasets import FieldDataset, SimDataset
+from cusanus.datasets import (FieldDataset, SimDataset,
+                              sample_boundary, object_onsets)
 from cusanus.tasks import KField
 
 class EFieldDataset(FieldDataset):
@@ -15,12 +16,15 @@ class EFieldDataset(FieldDataset):
                  segment_frames:int=30,
                  mean:np.ndarray=np.zeros(2),
                  std:np.ndarray=np.zeros(2),
+                 event_prob:float=1.0,
                  ):
 
         self.sim = sim
         self.segment_frames = segment_frames
         self.mean = mean
         self.std = std
+        # chance of splitting segments at a target collision
+        self.event_prob = event_prob
 
     def __len__(self):
         return len(self.sim)
@@ -69,10 +73,12 @@ class EFieldDataset(FieldDataset):
         # physics steps per frame
         spf = int(240 / fps)
         segment_steps = self.segment_frames * spf
-        # sample time range
+        # sample time range, split at a collision of the target
         # (double what was used from training kmodule)
-        t0 = np.random.randint(0, steps - segment_steps * 2)
-        t1 = t0 + segment_steps
+        onsets = object_onsets(state, target_id, len(registry))
+        t1, _ = sample_boundary(onsets, steps, segment_steps,
+                                self.event_prob)
+        t0 = t1 - segment_steps
         qsA = self.trial_from_sequence(x, t0, t1, spf)
 
         # pick second segment
@@ -80,6 +80,14 @@ class GFieldDataset(FieldDataset):
         self.qstd = qstd
         self.test = test
 
+    @classmethod
+    @property
+    def codecs(cls):
+        # queries only need half precision and
+        # occupancy is a single bit per query
+        return {'qs' : 'float16',
+                'ys' : 'bits'}
+
     @property
     def qsize(self):
         return 2
@@ -1,5 +1,6 @@
 import os
 import h5py
+import functools
 from tqdm import tqdm
 from typing import Type
 from torch.utils.data import Dataset
@@ -36,22 +37,33 @@ def write_to_hdf5(d:SizedDataset, path:str):
 
 
 class H5Dataset(SizedDataset):
+    """ HDF5 copy of a `SizedDataset` (see `write_to_hdf5`)
 
-    def __init__(self, d:Type[SizedDataset], src:str):
+    Instances belong to a subclass per wrapped dataset type
+    (`H5Dataset.of`) so that `parts`, `dtype` and `codecs` are class
+    attributes, as `load_ffcv` expects.
+    """
+
+    def __new__(cls, d:SizedDataset, src:str):
+        if cls is H5Dataset:
+            cls = H5Dataset.of(type(d))
+        return super().__new__(cls)
+
+    @staticmethod
+    @functools.lru_cache(maxsize = None)
+    def of(dcls:Type[SizedDataset]):
+        return type(f'H5{dcls.__name__}', (H5Dataset,),
+                    {'parts' : dcls.parts,
+                     'dtype' : dcls.dtype,
+                     'codecs' : dcls.codecs})
+
+    def __init__(self, d:SizedDataset, src:str):
         self.d = d
         self.src = h5py.File(src, 'r')
 
     def __len__(self):
         return self.src.attrs['len']
 
-    @property
-    def parts(self):
-        return self.d.parts
-
-    @property
-    def dtype(self):
-        return self.d.dtype
-
     @property
     def enum_shape(self):
         return self.d.enum_shape
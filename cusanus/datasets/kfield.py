@@ -5,7 +5,8 @@ import numpy as np
 import pybullet as p
 
 from cusanus.pytypes import *
-from cusanus.datasets import FieldDataset, SimDataset
+from cusanus.datasets import (FieldDataset, SimDataset,
+                              sample_boundary, object_onsets)
 from cusanus.tasks import KField
 
 class KFieldDataset(FieldDataset):
@@ -100,6 +101,7 @@ class KCodesDataset(FieldDataset):
                  segment_frames:int=30,
                  mean:np.ndarray=np.zeros(2),
                  std:np.ndarray=np.zeros(2),
+                 event_prob:float=1.0,
                  ):
 
         self.sim = sim
@@ -110,6 +112,8 @@ class KCodesDataset(FieldDataset):
         self.segment_frames = segment_frames
         self.mean = mean
         self.std = std
+        # chance of splitting segments at a target collision
+        self.event_prob = event_prob
 
     def __len__(self):
         return len(self.sim)
@@ -156,12 +160,16 @@ class KCodesDataset(FieldDataset):
         # physics steps per frame
         spf = int(240 / fps)
         segment_steps = self.segment_frames * spf
-        # sample time range
+        # sample time range, split at a collision of the target
         # (double what was used from training kmodule)
-        t0 = np.random.randint(0, steps - segment_steps * 2)
-        t1 = t0 + segment_steps
+        onsets = object_onsets(state, target_id, len(registry))
+        t1, _ = sample_boundary(onsets, steps, segment_steps,
+                                self.event_prob)
+        t0 = t1 - segment_steps
         qsA,ysA = self.trial_from_sequence(x, t0, t1, spf)
-        kfunc, kparams = self.kfield.fit_modulation(qsA, ysA)
+        # one query per frame
+        with self.kfield.module.frames(1):
+            kfunc, kparams = self.kfield.fit_modulation(qsA, ysA)
         mA = kfunc(kparams)
         t = torch.tensor([(t1-t0)/240],
                          dtype=torch.float32,
@@ -172,7 +180,8 @@ class KCodesDataset(FieldDataset):
         # pick second segment
         t2 = t1 + segment_steps
         qsB,ysB = self.trial_from_sequence(x, t1, t2, spf)
-        kfunc, kparams = self.kfield.fit_modulation(qsB, ysB)
+        with self.kfield.module.frames(1):
+            kfunc, kparams = self.kfield.fit_modulation(qsB, ysB)
         kB = kfunc(kparams).detach().cpu().numpy()
 
         return kA, kB
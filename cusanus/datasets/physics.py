@@ -12,7 +12,9 @@ from torch.utils.data import Dataset
 from cusanus.pytypes import *
 from cusanus.utils.physics import (mesh_to_bullet,
                                    sphere_to_bullet,
-                                   rect_to_bullet)
+                                   rect_to_bullet,
+                                   trajectory_aabbs,
+                                   broadphase_pairs)
 
 def _rect(x, y, z) -> trimesh.Trimesh:
     extents = [x[1]-x[0], y[1]-y[0], z[1]-z[0]]
@@ -168,12 +170,14 @@ class SimDataset(Dataset):
                  scene_dataset:SceneDataset,
                  max_dur:float = 5000.,
                  gravity:float = -10.0,
-                 debug = False
+                 debug = False,
+                 contact_margin:float = None,
                  ):
         self.scenes = scene_dataset
         self.max_dur = max_dur
         self.gravity = gravity
         self.debug = debug
+        self.contact_margin = contact_margin
 
     def __len__(self):
         return len(self.scenes)
@@ -253,10 +257,67 @@ class SimDataset(Dataset):
             'position' : position[:steps],
             'collision': collision[:steps],
         }
+        state.update(collision_onsets(state['collision']))
+        if not self.contact_margin is None:
+            state.update(self.candidate_pairs(scene, registry,
+                                              state['position']))
         # disconnect
         p.disconnect(physicsClientId = cid)
         return scene, registry, state
 
+    def candidate_pairs(self, scene:dict, registry:dict,
+                        position:np.ndarray):
+        """Broad-phase pruning of object pairs
+
+        Keeps the pairs whose swept boxes come within
+        `contact_margin`. Returns the kept pairs (k x 2 body ids),
+        their columns in the `collision` record and the fraction
+        of pairs pruned.
+        """
+        static = np.empty(len(registry), dtype = bool)
+        for (k, oid) in registry.items():
+            static[oid] = scene[k]['physics'].get('mass', 1.) == 0.
+        aabbs = trajectory_aabbs(scene, registry, position)
+        keep = broadphase_pairs(aabbs, static, self.contact_margin)
+        a, b = np.triu_indices(len(registry), k = 1)
+        return {
+            'pairs' : np.stack([a[keep], b[keep]], axis = 1),
+            'pair_index' : np.flatnonzero(keep),
+            'pruning_ratio' : 1.0 - keep.mean(),
+        }
+
+
+def event_pairs(state:dict, nobjects:int):
+    """Object pairs that event codes are fit for
+
+    The broad-phase candidates when the sim was run with a
+    `contact_margin`, otherwise every pair. `pair_index` selects
+    the matching columns of the `collision` record.
+    """
+    if 'pair_index' in state:
+        return {'pairs' : state['pairs'],
+                'pair_index' : state['pair_index']}
+    a, b = np.triu_indices(nobjects, k = 1)
+    return {'pairs' : np.stack([a, b], axis = 1),
+            'pair_index' : np.arange(len(a))}
+
+def collision_onsets(collision:np.ndarray):
+    """Index of contact onsets in a (steps x pairs) collision record
+
+    Returns the steps at which each contact starts and the
+    corresponding pair columns, ordered by step.
+    """
+    start = collision.copy()
+    start[1:] &= ~collision[:-1]
+    steps, pairs = np.nonzero(start)
+    return {'onset_steps' : steps, 'onset_pairs' : pairs}
+
+def object_onsets(state:dict, oid:int, nobjects:int):
+    """Onset steps of contacts involving body `oid`"""
+    a, b = np.triu_indices(nobjects, k = 1)
+    pairs = state['onset_pairs']
+    involved = (a[pairs] == oid) | (b[pairs] == oid)
+    return state['onset_steps'][involved]
 
 def _ncr(n, r):
     r = min(r, n-r)
@@ -0,0 +1,123 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler, DataLoader, Dataset
+
+from cusanus.pytypes import *
+
+# ragged axes of each scene part, by leading dimension
+ragged_axes = {
+    'g' : ('sequences', 'objects'),
+    'k' : ('sequences', 'objects'),
+    't' : ('sequences', 'objects'),
+    'pairs' : ('sequences', 'pairs'),
+    'qs' : ('sequences', 'objects'),
+    'ys' : ('sequences', 'objects'),
+}
+
+def _leaves(scene:dict, prefix = ()):
+    for (k, v) in scene.items():
+        if isinstance(v, dict):
+            yield from _leaves(v, prefix + (k,))
+        else:
+            yield prefix + (k,), v
+
+def scene_sizes(scene:dict, axes:dict = ragged_axes):
+    """Size of each ragged axis in a scene"""
+    sizes = {}
+    for (path, x) in _leaves(scene):
+        for (i, a) in enumerate(axes.get(path[-1], ())):
+            sizes[a] = max(sizes.get(a, 0), np.shape(x)[i])
+    return sizes
+
+def pad_scenes(scenes:List[dict], axes:dict = ragged_axes):
+    """Stacks scenes of different sizes into one padded batch
+
+    Every part listed in `axes` is zero padded along its ragged
+    dimensions to the largest scene in the batch. Padded pairs
+    index object 0 and must be masked.
+
+    The batch gains `masks` with a (scenes x max size) boolean mask
+    per ragged axis. Per-sequence copies of the object and pair
+    masks are added to `sequences` so that they follow the
+    sequences through `vmap`.
+    """
+    sizes = [scene_sizes(s, axes) for s in scenes]
+    names = set(a for s in sizes for a in s)
+    max_sizes = {a : max(s.get(a, 0) for s in sizes) for a in names}
+
+    def pad(path, x):
+        x = torch.as_tensor(np.asarray(x))
+        widths = [max_sizes[a] - x.shape[i] for (i, a) in
+                  enumerate(axes.get(path[-1], ()))]
+        if not any(widths):
+            return x
+        out = x.new_zeros(*[x.shape[i] + w for (i, w) in enumerate(widths)],
+                          *x.shape[len(widths):])
+        out[tuple(slice(0, n) for n in x.shape[:len(widths)])] = x
+        return out
+
+    def stack(path, values):
+        if isinstance(values[0], dict):
+            return {k : stack(path + (k,), [v[k] for v in values])
+                    for k in values[0]}
+        return torch.stack([pad(path, v) for v in values])
+
+    batch = stack((), scenes)
+    masks = {a : torch.stack([torch.arange(n) < s.get(a, 0)
+                              for s in sizes])
+             for (a, n) in max_sizes.items()}
+    batch['masks'] = masks
+    if 'sequences' in batch and 'sequences' in masks:
+        nseq = max_sizes['sequences']
+        for a in ['objects', 'pairs']:
+            if a in masks:
+                m = masks[a].unsqueeze(1).expand(-1, nseq, -1)
+                batch['sequences'][f'{a[:-1]}_mask'] = m
+    return batch
+
+
+class BucketBatchSampler(Sampler):
+    """Batches scenes of similar size to limit padding
+
+    Scenes are sorted by `sizes` (e.g. objects, pairs, sequences),
+    cut into batches and the batch order is shuffled every epoch.
+    """
+
+    def __init__(self, sizes:List[tuple], batch_size:int,
+                 shuffle:bool = True, drop_last:bool = False):
+        self.order = sorted(range(len(sizes)), key = lambda i: sizes[i])
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def batches(self):
+        b = self.batch_size
+        batches = [self.order[i:i + b] for i in
+                   range(0, len(self.order), b)]
+        if self.drop_last and batches and len(batches[-1]) < b:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.shuffle:
+            perm = np.random.permutation(len(batches))
+            batches = [batches[i] for i in perm]
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches())
+
+
+def scene_loader(scenes:Dataset, sizes:List[tuple], batch_size:int,
+                 shuffle:bool = True, drop_last:bool = False, **kwargs):
+    """Loader of padded scene batches (see `pad_scenes`)
+
+    `sizes` holds the ragged sizes of each scene, used to bucket
+    scenes of similar size together.
+    """
+    sampler = BucketBatchSampler(sizes, batch_size,
+                                 shuffle = shuffle,
+                                 drop_last = drop_last)
+    return DataLoader(scenes, batch_sampler = sampler,
+                      collate_fn = pad_scenes, **kwargs)
@@ -1,4 +1,6 @@
 import torch
+import numpy as np
+from torch import nn
 from abc import ABC, abstractmethod
 from torch.utils.data import Dataset
 from typing import Type
@@ -8,6 +10,7 @@ from ffcv.writer import DatasetWriter
 from ffcv.fields import NDArrayField
 from ffcv.fields.decoders import NDArrayDecoder
 from ffcv.loader import Loader, OrderOption
+from ffcv.reader import Reader
 from ffcv.transforms import (Convert, NormalizeImage, ToTensor,
     ToDevice)
 
@@ -25,6 +28,15 @@ class SizedDataset(Dataset, ABC):
     def dtype(cls) -> dict:
         pass
 
+    @classmethod
+    @property
+    def codecs(cls) -> dict:
+        """ Storage codec for each part (see `encode_part`).
+
+        `None` stores the part as its `dtype`.
+        """
+        return {p : None for p in cls.parts}
+
     @property
     @abstractmethod
     def enum_shape(self) -> dict:
@@ -37,23 +49,145 @@ class SizedDataset(Dataset, ABC):
     def load_ffcv(cls, path:str, device, **kwargs) -> Loader:
         return load_ffcv(cls, path, device, **kwargs)
 
+# Storage codecs
+#   None     : stored as `dtype`
+#   float16  : half precision
+#   bfloat16 : upper 16 bits of float32 stored as int16
+#   bits     : boolean values, bit-packed into uint8
+# All codecs are restored to float32 by the loader pipeline.
+#
+# NOTE: changing a dataset's codecs changes its file format.
+# `.beton` files written before (e.g. float32 GField data) must be
+# regenerated; `load_ffcv` refuses files whose stored dtype or
+# shape does not match (see `check_format`).
+def storage_dtype(codec:str, dtype:np.dtype) -> np.dtype:
+    if codec == 'float16':
+        return np.dtype('float16')
+    if codec == 'bfloat16':
+        return np.dtype('int16')
+    if codec == 'bits':
+        return np.dtype('uint8')
+    return dtype
+
+def storage_shape(codec:str, shape:Tuple[int, ...]) -> Tuple[int, ...]:
+    if codec == 'bits':
+        n = int(np.prod(shape))
+        return (int(np.ceil(n / 8)),)
+    return shape
+
+def encode_part(codec:str, x:np.ndarray) -> np.ndarray:
+    if codec == 'float16':
+        return x.astype(np.float16)
+    if codec == 'bfloat16':
+        # round to nearest even before truncating mantissa
+        u = np.ascontiguousarray(x, dtype = np.float32).view(np.uint32)
+        u = u + (0x7FFF + ((u >> 16) & 1))
+        return (u >> 16).astype(np.uint16).view(np.int16)
+    if codec == 'bits':
+        return np.packbits(np.asarray(x).reshape(-1) > 0.5)
+    return x
+
+class BFloat16ToFloat(nn.Module):
+    """ Decodes int16 storage of bfloat16 into float32 """
+
+    def forward(self, x:Tensor):
+        return x.view(torch.bfloat16).float()
+
+class UnpackBits(nn.Module):
+    """ Decodes bit-packed uint8 storage into float32 of `shape` """
+
+    def __init__(self, shape:Tuple[int, ...]):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.count = int(np.prod(shape))
+        self.register_buffer('shifts',
+                             torch.arange(7, -1, -1, dtype = torch.uint8),
+                             persistent = False)
+
+    def forward(self, x:Tensor):
+        shifts = self.shifts.to(x.device)
+        bits = (x.unsqueeze(-1) >> shifts) & 1
+        bits = bits.reshape(x.shape[0], -1)[:, :self.count]
+        return bits.reshape(x.shape[0], *self.shape).float()
+
+def decode_pipe(codec:str, shape:Tuple[int, ...] = None) -> list:
+    if codec == 'bfloat16':
+        return [BFloat16ToFloat()]
+    if codec == 'bits':
+        assert shape is not None, \
+            'bit-packed parts require their `enum_shape` to decode'
+        return [UnpackBits(shape)]
+    return [Convert(torch.float32)]
+
+class EncodedDataset(Dataset):
+    """ Applies the storage codecs of `d` to each trial """
+
+    def __init__(self, d:SizedDataset):
+        self.d = d
+
+    def __len__(self):
+        return len(self.d)
+
+    def __getitem__(self, idx):
+        trial = self.d[idx]
+        return tuple(encode_part(self.d.codecs[p], x)
+                     for p,x in zip(self.d.parts, trial))
+
 def write_ffcv(d:SizedDataset, path:str, **writer_kwargs):
     fields = {}
     for part in d.parts:
-        fields[part] = NDArrayField(dtype = d.dtype[part],
-                                    shape = d.enum_shape[part])
+        codec = d.codecs[part]
+        fields[part] = NDArrayField(
+            dtype = storage_dtype(codec, d.dtype[part]),
+            shape = storage_shape(codec, d.enum_shape[part]))
     writer = DatasetWriter(path, fields, **writer_kwargs)
-    writer.from_indexed_dataset(d)
+    writer.from_indexed_dataset(EncodedDataset(d))
+
+def check_format(cls:SizedDataset, p:str, enum_shape:dict = None):
+    """ Raises if `p` was not written with the codecs of `cls` """
+    handlers = Reader(p).handlers
+    for part in cls.parts:
+        if not part in handlers:
+            raise ValueError(f'{p} has no part {part!r}')
+        codec = cls.codecs[part]
+        stored = handlers[part]
+        expected = storage_dtype(codec, cls.dtype[part])
+        if np.dtype(stored.dtype) != expected:
+            raise ValueError(
+                f'{p}: part {part!r} is stored as {stored.dtype}, but '
+                f'{cls.__name__} expects {expected} (codec {codec}). '
+                'The file predates the current storage format; '
+                'regenerate it with `write_ffcv`.')
+        if not enum_shape is None and part in enum_shape:
+            shape = storage_shape(codec, enum_shape[part])
+            if tuple(stored.shape) != tuple(shape):
+                raise ValueError(
+                    f'{p}: part {part!r} has shape {stored.shape}, '
+                    f'expected {shape}; regenerate it with `write_ffcv`.')
+
+def load_ffcv(cls:SizedDataset, p:str, device,
+              enum_shape:dict = None,
+              order:OrderOption = OrderOption.RANDOM,
+              **kwargs):
+    """ Loads an ffcv dataset written by `write_ffcv`
 
-def load_ffcv(cls:SizedDataset, p:str, device, **kwargs):
+    Compact parts are moved to `device` before being
+    decoded to float32. `enum_shape` is required for
+    bit-packed parts. Use `OrderOption.SEQUENTIAL` when
+    batch indices need to identify trials. Files written with
+    other codecs are rejected (see `check_format`).
+    """
+    check_format(cls, p, enum_shape)
+    enum_shape = {} if enum_shape is None else enum_shape
     pipes = {}
     for part in cls.parts:
         pipe = [NDArrayDecoder(),
-                ToTensor(),
-                Convert(torch.float32)]
+                ToTensor()]
         if not device is None:
             pipe.append(ToDevice(device))
+        codec = cls.codecs[part]
+        pipe.extend(decode_pipe(codec, enum_shape.get(part)))
         pipes[part] = pipe
 
-    return Loader(p, pipelines = pipes, order = OrderOption(2),
+    return Loader(p, pipelines = pipes, order = order,
                   **kwargs)
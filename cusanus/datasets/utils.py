@@ -38,3 +38,21 @@ class RunningStats:
 
     def standard_deviation(self):
         return np.sqrt(self.variance())
+
+
+def sample_boundary(onsets:np.ndarray, steps:int, segment_steps:int,
+                    event_prob:float = 1.0):
+    """Samples the boundary between two consecutive segments
+
+    With probability `event_prob` the boundary is a random contact
+    onset (from `onsets`), so that the second segment starts at the
+    event. Otherwise, or if no onset leaves room for both segments,
+    the boundary is uniform.
+
+    Returns the boundary step and whether it is an onset.
+    """
+    lo, hi = segment_steps, steps - segment_steps
+    valid = onsets[(onsets >= lo) & (onsets < hi)]
+    if len(valid) and np.random.rand() < event_prob:
+        return valid[np.random.randint(len(valid))], True
+    return np.random.randint(lo, hi), False
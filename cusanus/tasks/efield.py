@@ -29,46 +29,41 @@ class EField(ImplicitNeuralField):
                  lr:float = 0.001,
                  lr_inner:float = 0.001,
                  weight_decay:float = 0.001,
-                 sched_gamma:float = 0.8) -> None:
+                 sched_gamma:float = 0.8,
+                 compile_inner:bool = False,
+                 compile_backend:str = 'inductor',
+                 inner_tol:float = 0.0,
+                 max_inner_steps:int = None,
+                 mod_cache_size:int = 0,
+                 mod_cache_tol:float = 0.01,
+                 mod_cache_decay:float = 0.0,
+                 meta_grad:str = 'full',
+                 cg_steps:int = 5,
+                 cg_damping:float = 0.0,
+                 checkpoint_steps = None,
+                 learn_inner_lr:bool = False,
+                 per_step_lr:bool = False,
+                 precision:str = 'float32',
+                 fp32_sine:bool = True,
+                 empty_cache:bool = False) -> None:
         super(ImplicitNeuralField, self).__init__()
         self.save_hyperparameters(ignore = ['module',
                                             'kfield'])
         self.module = module
-        self.kfield = kfield
+        self.check_hparams()
+        self.init_inner_lr()
+        self.init_precision()
+        # only used to extract codes; frozen so that DDP does not
+        # expect gradients for it
+        self.kfield = None if kfield is None else \
+            kfield.requires_grad_(False)
 
 
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def test_step(self, batch, batch_idx):
-        (qs, ys) = batch
-        qs = qs[0]
-        ys = ys[0]
-        m = self.fit_modulation(qs, ys)
-        k2 = self.eval_modulation(m, qs)
-        pred_loss = self.pred_loss(qs, ys, k2).detach().cpu()
-        self.log('test_loss', pred_loss)
-        return {'loss' : pred_loss,
-                'mod' : m,
-                'pred':k2}
-
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def validation_step(self, batch, batch_idx):
-        (qs, ys) = batch
-        qs = qs[0]
-        ys = ys[0]
-        m = self.fit_modulation(qs, ys)
-        k2 = self.eval_modulation(m, qs)
-        pred_loss = self.pred_loss(qs, ys, k2).detach().cpu()
-        self.log('val_loss', pred_loss)
-        return {'loss' : pred_loss,
-                'mod' : m,
-                'pred':k2}
-
     def configure_optimizers(self):
 
         params = [
             {'params': self.module.inr.theta.parameters()},
+            *self.inner_lr_params(),
         ]
         optimizer = optim.Adam(params,
                                lr=self.hparams.lr,
@@ -1,59 +1,82 @@
 import os
+import time
 import torch
 import torchopt
 import functools
-from torch import optim
+from torch import nn, optim
 from torch.nn.functional import mse_loss, l1_loss
 import pytorch_lightning as pl
-from functorch import vmap, make_functional_with_buffers, grad
+from torch.utils._pytree import tree_map, tree_flatten
+from functorch import (vmap, make_functional_with_buffers, grad,
+                       grad_and_value)
 
 from cusanus.pytypes import *
-from cusanus.archs import ImplicitNeuralModule, LatentModulation
+from cusanus.archs.event_module import ObjState
 
 class EventConcepts(pl.LightningModule):
     """Training schema for event concepts
 
-    TODO
+    Each training batch holds padded sims (see `pad_scenes`). For
+    every sim, event codes (one per candidate pair and sequence)
+    and dynamics codes (one per object) are fit by alternating
+    blocks (`fit_sims`). The event and update modules are then
+    trained on the query loss under the fitted codes.
+
+    Arguments:
+        event_module: EventModule
+        update_module: UpdateModule
+        kfield: module, `(qs, kmod) -> likelihood` of an object's
+            queries after an event. Frozen
+        e_dim: int, event code size
+        d_dim: int, dynamics code size
+        emod_steps: int = 5, inner steps per event block
+        dmod_steps: int = 5, inner steps per dynamics block
+        block_steps: int = 3, maximum alternations of event and
+            dynamics fitting in `fit_sims`
+        block_tol: float = 0.0, freeze a sim once its joint loss
+            improves by less than this fraction (see `fit_sims`)
+        block_time_limit: float = None, stop alternating after this
+            many seconds
     """
 
     def __init__(self,
-                 inr: ImplicitNeuralModule,
-                 inner_steps:int = 5,
+                 event_module: nn.Module,
+                 update_module: nn.Module,
+                 kfield: nn.Module,
+                 e_dim:int,
+                 d_dim:int,
+                 emod_steps:int = 5,
+                 dmod_steps:int = 5,
                  lr:float = 0.001,
                  lr_inner:float = 0.001,
                  weight_decay:float = 0.001,
-                 sched_gamma:float = 0.8) -> None:
+                 sched_gamma:float = 0.8,
+                 block_steps:int = 3,
+                 block_tol:float = 0.0,
+                 block_time_limit:float = None) -> None:
         super().__init__()
-        self.save_hyperparameters(ignore = ['C', 'F', 'U', 'K'])
-        self.C = C
-        self.F = F
-        self.U = U
+        self.save_hyperparameters(ignore = ['event_module',
+                                            'update_module',
+                                            'kfield'])
+        self.event_module = event_module
+        self.update_module = update_module
+        self.K = kfield.requires_grad_(False)
 
-    def initialize_modulation(self, d:int):
-        m = LatentModulation(d)
-        m.to(self.device)
-        m.train() # REVIEW: is this neccessary?
-        return make_functional(m)
+    def init_codes(self, *shape:int):
+        """Zero codes of `shape` (in functional, tuple form)"""
+        return (torch.zeros(*shape, device = self.device),)
 
-    def initialize_emod(self):
-        self.initialize_modulation(self.e_dim)
+    def init_emods(self, *shape:int):
+        return latent_code, self.init_codes(*shape, self.hparams.e_dim)
 
-    def initialize_dmod(self):
-        self.initialize_modulation(self.d_dim)
+    def init_dmods(self, *shape:int):
+        return latent_code, self.init_codes(*shape, self.hparams.d_dim)
 
-    def init_emods(self, n:int):
-        f, _ = self.initialize_emod()
-        params = [self.initialize_emod[1] for _ in range(n)]
-        return f, params
-
-    def init_dmods(self, n:int):
-        f, _ = self.initialize_dmod()
-        params = [self.initialize_dmod()[1] for _ in range(n)]
-        return f, params
+    def mod_optim(self):
+        return torchopt.sgd(lr=self.hparams.lr_inner)
 
     def init_mod_optim(self, mparams):
-        lr = self.hparams.lr_inner
-        opt = torchopt.sgd(lr=lr)
+        opt = self.mod_optim()
         opt_state = opt.init(mparams)
         return (opt, opt_state)
 
@@ -65,47 +88,48 @@ class EventConcepts(pl.LightningModule):
                                          (pred_ys * (1.0 - pvals))))
         return pred_loss
 
-    def pred_loss(self, qs, pred_ys, pvals, kmods):
-        """Average loss across objects"""
+    def pred_loss(self, qs, pred_ys, pvals, kmods, mask = None):
+        """Average loss across (unpadded) objects"""
         vl = vmap(self.pred_loss_inner)(qs, pred_ys,
                                         pvals, kmods)
-        return torch.mean(vl)
+        return masked_mean(vl, mask)
 
     def extract_emods(self, params):
         # assumes batched eparams (events x edim)
-        f, _ = self.initialize_emod()
-        return vmap(f)(params)
+        return vmap(latent_code)(params)
 
     def extract_dmods(self, params):
         # assumes batched params (objects x ddim)
-        f, _ = self.initialize_dmod()
-        return vmap(f)(params)
+        return vmap(latent_code)(params)
 
-    def backward(self, loss, optimizer, optimizer_idx):
+    def backward(self, loss, *args, **kwargs):
         loss.backward()   # average loss of all modulations
-        optimizer.step()  # outer optimizer
-        torch.cuda.empty_cache()
 
-    def training_step(self, batch, batch_idx, optimizer_idx = 0):
-        # each task in the batch a simulation scene
+    def training_step(self, batch, batch_idx):
+        # each task in the batch a simulation scene, padded to
+        # a common size (see `pad_scenes`)
+        loss, stats = self.meta_loss(batch)
+        self.log('loss', loss.detach())
+        self.log('block_steps', float(len(stats)))
+        self.log('block_loss', stats[-1]['loss'])
+        self.log('block_sec', sum(r['sec'] for r in stats))
+        self.log('train_loss', loss.detach(), on_step = False,
+                 on_epoch = True, sync_dist = True)
+        return loss
+
+    def meta_loss(self, batch:dict):
+        """Query loss of a padded batch of sims and block stats"""
         # Fitting modulations for current generation in parallel
-        vloss = vmap(functools.partial(event_loop,
-                                       self))
-        # fit modulations on batch - returns averaged loss
+        stats = []
+        dmods, emods = fit_sims(self, batch, stats)
+        vloss = vmap(functools.partial(event_loop, self))
         # Compute the maml loss by aggregate loss.
-        loss = torch.mean(vloss(batch))
-        self.log('loss', mod_losses.item())
-        return loss # overriding `backward`. See above
-
-    def fit_modulation(self, qs:Tensor, ys:Tensor):
-        return fit_modulation(self, qs, ys)
-
-    def eval_modulation(self, m, qs:Tensor):
-        return eval_modulation(self, m, qs)
+        return torch.mean(vloss(batch, dmods, emods)), stats
 
     def configure_optimizers(self):
-
-        optimizer = optim.Adam(self.inr.theta.parameters(),
+        params = [*self.event_module.parameters(),
+                  *self.update_module.parameters()]
+        optimizer = optim.Adam(params,
                                lr=self.hparams.lr,
                                weight_decay=self.hparams.weight_decay)
         gamma = self.hparams.sched_gamma
@@ -113,156 +137,269 @@ class EventConcepts(pl.LightningModule):
                                                      gamma = gamma)
         return [optimizer], [scheduler]
 
-def eval_event_modulation(exp, seq, dmods, pair, emod):
-    (a_key, b_key) = pair
-    a = seq['objects'][a_key]
-    b = seq['objects'][b_key]
-    a_dmod = dmods[a_key]
-    b_dmod = dmods[b_key]
-    return exp.event_module(a, b, emod, a_dmod, b_dmod)
-
-def update_state(exp, seq, pvals, fmods, dmods, obj_key):
-    obj = seq['objects'][obj_key]
-    pairs = seq['pairs']
-    dmod = dmods[obj_key]
-    fmod = torch.zeros_like(fmods[0])
-    pval = torch.ones(1).to(exp.device)
-    for (a,b),f,p in zip(pairs, fmods, pvals):
-        if a == obj_key:
-            fmod += f
-            pval *= p
-        elif b == obj_key:
-            fmod -= f
-            pval *= p
-
-    return pval, exp.update_module(obj, fmod, dmod)
+def latent_code(params):
+    """Functional form of a latent code: the code itself"""
+    return params[0]
+
+def seq_objects(seq:dict):
+    """Object states of a sequence (see `ragged_axes`)"""
+    return ObjState(seq['g'], seq['k'], seq['t'])
+
+def eval_event_modulation(exp, seq, dmods, emods):
+    """Event pvals and forces for every pair in `seq`"""
+    # objects are encoded once, then gathered per pair
+    return exp.event_module.pair_events(
+        seq_objects(seq), seq['pairs'], emods, dmods)
+
+def masked_mean(x:Tensor, mask:Tensor = None):
+    """Mean over the leading dimension, ignoring padding"""
+    if mask is None:
+        return torch.mean(x)
+    mask = mask.reshape(-1, *[1] * (x.dim() - 1))
+    n = mask.sum() * x[0].numel()
+    return torch.sum(torch.where(mask, x, 0.0)) / n.clamp_min(1)
+
+def masked_sq_sum(x:Tensor, mask:Tensor = None):
+    """Squared norm over unpadded rows"""
+    if mask is None:
+        return torch.sum(x ** 2)
+    mask = mask.reshape(-1, *[1] * (x.dim() - 1))
+    return torch.sum(torch.where(mask, x, 0.0) ** 2)
+
+def aggregate_pairs(pairs:Tensor, n:int, fmods:Tensor, pvals:Tensor,
+                    mask:Tensor = None, eps:float = 1e-12):
+    """Accumulates pair events onto `n` objects
+
+    `pairs` holds (a, b) object indices (pairs x 2). Each event adds
+    its force to `a` and subtracts it from `b` (a signed incidence
+    relation) and multiplies into the pval of both. Products are
+    taken as sums of logs so both reduce to `index_add`.
+    Padded pairs (`mask` false) contribute nothing.
+
+    Returns object pvals (n x 1) and forces (n x fdim).
+    """
+    (a, b) = pairs[:, 0], pairs[:, 1]
+    fmods = fmods.reshape(len(pairs), -1)
+    logp = torch.log(pvals.reshape(len(pairs)).clamp_min(eps))
+    if not mask is None:
+        fmods = torch.where(mask.unsqueeze(1), fmods, 0.0)
+        logp = torch.where(mask, logp, 0.0)
+    fmod = fmods.new_zeros(n, fmods.shape[1])
+    fmod = fmod.index_add(0, a, fmods).index_add(0, b, -fmods)
+    logp_obj = logp.new_zeros(n)
+    logp_obj = logp_obj.index_add(0, a, logp).index_add(0, b, logp)
+    return torch.exp(logp_obj).unsqueeze(1), fmod
+
+def update_states(exp, seq, pvals, fmods, dmods):
+    """Applies the aggregated events to every object"""
+    pval, fmod = aggregate_pairs(seq['pairs'], len(dmods),
+                                 fmods, pvals,
+                                 mask = seq.get('pair_mask'))
+    # updates the `ObjState` of all objects at once
+    new_ks = exp.update_module(seq_objects(seq), fmod, dmods).k
+    return pval, new_ks
 
 def eval_event_modulations(exp, seq, dmods, emods):
     """Applieds m events to n objects"""
-    eval_emod = functools.partial(eval_event_modulation,
-                                  exp, seq, dmods)
-    pairs = seq['pairs']
     # forces for each event
-    pvals, fmods = vmap(efunc)(pairs, emods)
-
-    update_func = functools.partial(update_state,
-                                    seq, fmods,
-                                    dmods)
+    pvals, fmods = eval_event_modulation(exp, seq, dmods, emods)
     # updated states for each object
     # with pvals for each update
-    pvals, new_ks = vmap(update_func)(obj_keys)
+    pvals, new_ks = update_states(exp, seq, pvals, fmods, dmods)
     return (pvals, new_ks)
 
 
 
-def fit_event_modulations(exp, dmods, seq:dict):
-    """Fits event codes for each pair of objects in a sequence"""
-    efunc, eparams = exp.init_emods(len(seq['pairs']))
-    eopt, eopt_state = exp.init_mod_optim(eparams)
+def fit_event_modulations(exp, dmods, seq:dict, eparams, eopt_state):
+    """Fits event codes for each pair of objects in a sequence
+
+    One code is fit per pair in `seq['pairs']`, starting from
+    `eparams` and `eopt_state` (see `fit_sims`). Sequences built
+    with `event_pairs` only list the broad-phase candidates.
+
+    Returns the codes, optimizer state and final loss.
+    """
+    eopt = exp.mod_optim()
     eval_f = functools.partial(eval_event_modulations,
                                exp, seq, dmods)
     def compute_loss(eparams):
-        emods = vmap(efunc)(eparams)
+        emods = vmap(latent_code)(eparams)
         # new pvals and states
         pvals, kmods = eval_f(emods)
         qs = seq['qs']
         ys = seq['ys']
         # average loss across objects
-        pred_loss = exp.pred_loss(qs, pvals, ys, kmods)
+        pred_loss = exp.pred_loss(qs, ys, pvals, kmods,
+                                  mask = seq.get('object_mask'))
         # keep components near 0
-        l2_emod = torch.sum(emods ** 2)
+        l2_emod = masked_sq_sum(emods, seq.get('pair_mask'))
         # NOTE: Possible to use NFs here
-        l2_kmod = torch.sum(kmods ** 2)
+        l2_kmod = masked_sq_sum(kmods, seq.get('object_mask'))
         return pred_loss + l2_emod + l2_kmod
 
     new_eparams = eparams
     for _ in range(exp.hparams.emod_steps):
-        grads = grad(compute_loss)(new_eparams)
+        grads, loss = grad_and_value(compute_loss)(new_eparams)
         updates, eopt_state = eopt.update(grads, eopt_state,
                                           inplace=False)
         new_eparams = torchopt.apply_updates(new_eparams, updates,
                                              inplace=False)
 
-    return new_eparams
+    return new_eparams, eopt_state, loss
 
 def eval_dynamics_modulations(exp, dmods, emods, seq):
     return eval_event_modulations(exp, seq, dmods, emods)
 
 def loss_dynamics_modulations(exp, dmods, emods, seq):
     pvals, kmods = eval_event_modulations(exp, seq, dmods, emods)
+    qs = seq['qs']
     ys = seq['ys']
     # average loss across objects
-    pred_loss = exp.pred_loss(qs, pvals, ys, kmods)
+    pred_loss = exp.pred_loss(qs, ys, pvals, kmods,
+                              mask = seq.get('object_mask'))
     # keep components near 0
     # NOTE: Possible to use NFs here
-    l2_kmod = torch.sum(kmods ** 2)
+    l2_kmod = masked_sq_sum(kmods, seq.get('object_mask'))
     return pred_loss + l2_kmod
 
-def fit_dynamics_modulations(exp, sim, eparams):
-    """Fits dynamics codes to objects across a sim"""
+def fit_dynamics_modulations(exp, sim, emods, dparams, dopt_state):
+    """Fits dynamics codes to objects across a sim
 
-    dfunc, dparams = exp.init_dmods(sim['nobjects'])
-    dopt, dopt_state = exp.init_mod_optim(dparams)
-    # only need efunc
-    efunc, _ = exp.init_emods(seq)
-    seqs = sim['sequences']
+    Starts from `dparams` and `dopt_state` (see `fit_sims`) with
+    the event codes `emods` (sequences x pairs x edim) fixed.
 
+    Returns the codes, optimizer state and final loss.
+    """
+    dopt = exp.mod_optim()
+    seqs = sim['sequences']
+    masks = sim.get('masks', {})
 
     def compute_loss(dparams):
-        dmods = vmap(dfunc)(dparams)
+        dmods = vmap(latent_code)(dparams)
         eval_f = vmap(functools.partial(loss_dynamics_modulations,
                                         exp,
                                         dmods))
-        # dloss: seq x object
-        dloss = eval_f(eparams, seqs)
-        dloss = torch.mean(dloss)
-        l2_loss = torch.sum(dmods ** 2)
+        # dloss: one per sequence
+        dloss = eval_f(emods, seqs)
+        dloss = masked_mean(dloss, masks.get('sequences'))
+        l2_loss = masked_sq_sum(dmods, masks.get('objects'))
         return dloss + l2_loss
 
     new_dparams = dparams
     for _ in range(exp.hparams.dmod_steps):
-        grads = grad(compute_loss)(new_dparams)
-        updates, dopt_state = eopt.update(grads, dopt_state,
+        grads, loss = grad_and_value(compute_loss)(new_dparams)
+        updates, dopt_state = dopt.update(grads, dopt_state,
                                           inplace=False)
         new_dparams = torchopt.apply_updates(new_dparams, updates,
                                              inplace=False)
 
-    return new_dparams
+    return new_dparams, dopt_state, loss
 
 
-def fit_sim(exp, sim:dict):
-    # init dmods
-    dfunc, dparams = exp.init_dmods(sim)
-    dmods = vmap(dfunc, dparams)
-
-    seqs = sim['sequences']
-
-    for _ in range(exp.hparams.block_steps):
-        # BLOCK 1: emods
-        emod_f = vmap(functools.partial(
-            fit_event_modulations,
-            exp,
-            dmods))
-        eparams = emod_f(seqs)
-        # seqs x nevents x edim
-        emods = vmap(exp.extract_emods)(eparams)
-
-        # BLOCK 2: dmods
-        dparams = fit_dynamics_modulations(exp, sim, emods)
-        # objects x ddim
-        dmods = exp.extract_dmods(dparams)
+def fit_block(exp, sim:dict, dparams, dopt_state, eparams, eopt_state):
+    """One alternation of event and dynamics fitting for a sim
 
+    Continues from the given codes and optimizer states, which are
+    initialized outside of `vmap` (see `fit_sims`). Returns the new
+    ones and the joint loss.
+    """
+    dmods = exp.extract_dmods(dparams)
+    # BLOCK 1: emods
+    emod_f = vmap(functools.partial(
+        fit_event_modulations,
+        exp,
+        dmods))
+    eparams, eopt_state, _ = emod_f(sim['sequences'], eparams, eopt_state)
+    # seqs x nevents x edim
+    emods = vmap(exp.extract_emods)(eparams)
+
+    # BLOCK 2: dmods
+    dparams, dopt_state, loss = fit_dynamics_modulations(
+        exp, sim, emods, dparams, dopt_state)
+    return (dparams, dopt_state, eparams, eopt_state), loss
+
+def init_sim_codes(exp, sims:dict):
+    """Initial codes and optimizer states for a batch of sims
+
+    Sizes are read from the padded batch (see `pad_scenes`):
+    dynamics codes are (sims x objects x ddim) and event codes
+    (sims x sequences x pairs x edim).
+    """
+    (b, s, p) = sims['sequences']['pairs'].shape[:3]
+    n = sims['sequences']['g'].shape[2]
+    _, dparams = exp.init_dmods(b, n)
+    _, eparams = exp.init_emods(b, s, p)
+    _, dopt_state = exp.init_mod_optim(dparams)
+    _, eopt_state = exp.init_mod_optim(eparams)
+    return (dparams, dopt_state, eparams, eopt_state)
+
+def _select(active:Tensor, new, old):
+    """Leaves of `new` for active sims, `old` otherwise"""
+    old = iter(tree_flatten(old)[0])
+    return tree_map(
+        lambda n: torch.where(active.view(-1, *[1] * (n.dim() - 1)),
+                              n, next(old)),
+        new)
+
+def fit_sims(exp, sims:dict, stats:list = None):
+    """Alternates fitting event and dynamics codes for a batch of sims
+
+    Each block (`fit_block`, vmapped over sims) continues from the
+    codes and optimizer states of the previous one. Alternation
+    ends after `block_steps` or once `block_time_limit` seconds
+    have passed. With `block_tol`, a sim whose joint loss improves
+    by less than that fraction is frozen (as in
+    `fit_modulation_tol`) and the loop ends once every sim has
+    converged, at the cost of one host sync per block.
+
+    If given, `stats` receives a record per block with its
+    duration, mean loss and number of sims still active.
+
+    Returns the dynamics (sims x objects x ddim) and event codes.
+    """
+    tol = exp.hparams.block_tol
+    limit = exp.hparams.block_time_limit
+    vblock = vmap(functools.partial(fit_block, exp))
+    carry = init_sim_codes(exp, sims)
+    active, prev_loss = None, None
+    start = time.perf_counter()
+
+    for block in range(exp.hparams.block_steps):
+        t0 = time.perf_counter()
+        new_carry, loss = vblock(sims, *carry)
+        if active is None:
+            active = torch.ones_like(loss, dtype = torch.bool)
+        carry = _select(active, new_carry, carry)
+        loss = loss.detach()
+        if not stats is None:
+            stats.append({'block' : block,
+                          'sec' : time.perf_counter() - t0,
+                          'loss' : loss.mean(),
+                          'active' : active.sum()})
+        if not prev_loss is None and tol > 0:
+            active = active & (prev_loss - loss > tol * prev_loss.abs())
+            # single host sync per block
+            if not torch.any(active):
+                break
+        prev_loss = torch.where(active, loss, prev_loss) \
+            if not prev_loss is None else loss
+        if not limit is None and time.perf_counter() - start > limit:
+            break
+
+    (dparams, _, eparams, _) = carry
+    dmods = vmap(exp.extract_dmods)(dparams)
+    emods = vmap(vmap(exp.extract_emods))(eparams)
     return dmods, emods
 
 
-def event_loop(exp, sim:dict):
-    dmods, emods = fit_sim(exp, sim)
+def event_loop(exp, sim:dict, dmods:Tensor, emods:Tensor):
+    """Query loss of a sim under its fitted codes (see `fit_sims`)"""
     # The final set of adapted parameters will induce some
     # final loss and accuracy on the query dataset.
     # These will be used to update the model's meta-parameters.
     seqs = sim['sequences']
-    eval_f = vmap(functools.partial(eval_dynamics_modulations,
-                                    dmods, emods))
-    _,  vloss = eval_f(seqs)
-    pred_loss = torch.mean(vloss)
+    eval_f = vmap(functools.partial(loss_dynamics_modulations,
+                                    exp, dmods))
+    vloss = eval_f(emods, seqs)
+    pred_loss = masked_mean(vloss, sim.get('masks', {}).get('sequences'))
     return pred_loss
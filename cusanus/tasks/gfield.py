@@ -14,31 +14,22 @@ class GField(ImplicitNeuralField):
         sched_gamma: float = 0.8
     """
 
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def test_step(self, batch, batch_idx):
+    def eval_step(self, batch, batch_idx, stage:str):
         (qs, ys) = batch
-        qs = qs[0]
-        ys = ys[0]
-        m = self.fit_modulation(qs, ys)
-        pred = self.eval_modulation(m, qs)
+        losses, mods, pred, steps = self.eval_batch(batch, batch_idx,
+                                                    stage)
         pred_diff = ys - pred
-        pred_loss = self.pred_loss(qs, ys, pred).detach().cpu()
-        self.log('test_loss', pred_loss)
-        return {'loss' : pred_loss,
-                'mod'  : m,
-                'pred_diff' : pred_diff.detach().cpu()}
-
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def validation_step(self, batch, batch_idx):
-        return self.test_step(batch, batch_idx)
+        return {'loss' : losses,
+                'mod'  : mods,
+                'steps' : steps,
+                'pred_diff' : pred_diff.cpu()}
 
     def configure_optimizers(self):
 
         params = [
             {'params': self.module.scale_field.parameters()},
             {'params': self.module.occ_field.theta.parameters()},
+            *self.inner_lr_params(),
         ]
         optimizer = optim.Adam(params,
                                lr=self.hparams.lr,
@@ -1,13 +1,18 @@
 import torch
 import torchopt
+from torch import nn
 from torch import optim
+from torch.utils.checkpoint import checkpoint
 from torch.nn.functional import mse_loss
 import pytorch_lightning as pl
 from functools import partial
-from functorch import vmap, make_functional, grad
+from collections import OrderedDict
+from functorch import vmap, make_functional, grad, jvp
 
 from cusanus.pytypes import *
-from cusanus.archs import ImplicitNeuralModule, LatentModulation
+from cusanus.archs import (ImplicitNeuralModule, LatentModulation,
+                           fp32_first_layers)
+from cusanus.utils.profiling import StepProfile
 
 class ImplicitNeuralField(pl.LightningModule):
     """Implements a generic task implicit neural fields
@@ -17,18 +22,142 @@ class ImplicitNeuralField(pl.LightningModule):
         lr: float = 0.001, learning rate
         weight_decay: float = 0.001
         sched_gamma: float = 0.8
+        compile_inner: bool = False, compile the meta-training
+            step with `torch.compile` (see `compiled_modulation_loop`)
+        compile_backend: str = 'inductor'
+        inner_tol: float = 0.0, when positive, modulations fit
+            outside of meta-training stop once the prediction loss
+            is within `inner_tol` (see `fit_modulation_tol`)
+        max_inner_steps: int = None, step limit for `inner_tol`
+            (defaults to `inner_steps`)
+        mod_cache_size: int = 0, when positive, evaluation fits are
+            warm-started from an LRU cache of previously fit codes
+            (see `ModulationCache`). Requires `inner_tol > 0`
+        mod_cache_tol: float = 0.01, relative change in outer weights
+            that invalidates the cache
+        mod_cache_decay: float = 0.0, scale applied to cached codes
+            on invalidation (0 clears the cache)
+        meta_grad: str = 'full', how the meta-gradient treats the
+            inner loop. One of
+            'full'        : backpropagate through every inner step
+            'first_order' : stop-gradient through inner updates
+            'implicit'    : implicit function theorem, solved with CG
+                            in the latent space
+        cg_steps: int = 5, CG iterations for 'implicit'
+        cg_damping: float = 0.0, added to the inner Hessian for 'implicit'
+        checkpoint_steps: list or str = None, inner steps whose
+            activations are recomputed during the outer backward
+            ('all' for every step), with `meta_grad = 'full'` only.
+            See `checkpointed_modulation_loop`.
+            Layer checkpointing (`SirenNet(checkpoint_layers = ...)`)
+            is JAX-only and has no effect on this task
+        learn_inner_lr: bool = False, meta-learn per-latent-dimension
+            inner learning rates (Meta-SGD), initialized to `lr_inner`
+        per_step_lr: bool = False, with `learn_inner_lr`, learn
+            separate rates for each inner step
+        precision: str = 'float32', 'bfloat16' runs meta-training
+            and modulation fitting under autocast. Modulations,
+            weights and loss reductions stay in float32
+        fp32_sine: bool = True, compute the first layer of each
+            Siren (whose sine argument is scaled by `w0_initial`) in
+            float32 under autocast (see `fp32_first_layers`)
+        empty_cache: bool = False, release cached CUDA memory after
+            every outer step
     """
 
+    # whether DDP must look for parameters without gradients. Tasks
+    # keep every trainable parameter in the loss (frozen submodules
+    # are excluded with `requires_grad_(False)`) so the reducer can
+    # skip the search
+    ddp_find_unused_parameters = False
+
     def __init__(self,
                  module: ImplicitNeuralModule,
                  inner_steps:int = 5,
                  lr:float = 0.001,
                  lr_inner:float = 0.001,
                  weight_decay:float = 0.001,
-                 sched_gamma:float = 0.8) -> None:
+                 sched_gamma:float = 0.8,
+                 compile_inner:bool = False,
+                 compile_backend:str = 'inductor',
+                 inner_tol:float = 0.0,
+                 max_inner_steps:int = None,
+                 mod_cache_size:int = 0,
+                 mod_cache_tol:float = 0.01,
+                 mod_cache_decay:float = 0.0,
+                 meta_grad:str = 'full',
+                 cg_steps:int = 5,
+                 cg_damping:float = 0.0,
+                 checkpoint_steps = None,
+                 learn_inner_lr:bool = False,
+                 per_step_lr:bool = False,
+                 precision:str = 'float32',
+                 fp32_sine:bool = True,
+                 empty_cache:bool = False) -> None:
         super().__init__()
         self.save_hyperparameters(ignore = 'module')
         self.module = module
+        self.check_hparams()
+        self.init_inner_lr()
+        self.init_precision()
+
+    def check_hparams(self):
+        """Rejects hyperparameters that cannot be combined"""
+        hp = self.hparams
+        if hp.meta_grad not in meta_grad_modes:
+            raise ValueError(f'meta_grad must be one of {meta_grad_modes}')
+        if hp.compile_inner:
+            # `compiled_modulation_loop` traces plain unrolled steps
+            if hp.meta_grad == 'implicit':
+                raise ValueError('`compile_inner` does not support '
+                                 'implicit meta-gradients')
+            if hp.checkpoint_steps:
+                raise ValueError('`compile_inner` does not support '
+                                 '`checkpoint_steps`')
+        if hp.checkpoint_steps and hp.meta_grad != 'full':
+            # other modes keep no activations of the inner steps
+            raise ValueError('`checkpoint_steps` requires '
+                             '`meta_grad = \'full\'`')
+        if hp.mod_cache_size > 0 and not hp.inner_tol > 0:
+            # a fixed number of steps from a warm start fits further
+            # every epoch, so evaluation losses would drift with it
+            raise ValueError('`mod_cache_size` requires `inner_tol > 0`')
+        if hp.meta_grad == 'implicit' and hp.learn_inner_lr:
+            # the implicit gradient only reaches the outer weights
+            # through the fitted code, never the inner rates
+            raise ValueError('`learn_inner_lr` does not support '
+                             'implicit meta-gradients')
+
+    def init_inner_lr(self):
+        if not self.hparams.learn_inner_lr:
+            return
+        steps = self.hparams.inner_steps if self.hparams.per_step_lr else 1
+        lr = torch.full((steps, self.module.mod), self.hparams.lr_inner)
+        self.inner_lr = nn.Parameter(lr)
+
+    def inner_lr_at(self, step:int):
+        """Inner learning rate for `step` (scalar or per-dimension)"""
+        if not self.hparams.learn_inner_lr:
+            return self.hparams.lr_inner
+        return self.inner_lr[min(step, len(self.inner_lr) - 1)]
+
+    def inner_lr_params(self):
+        """Optimizer parameter groups for learned inner rates"""
+        if not self.hparams.learn_inner_lr:
+            return []
+        return [{'params': [self.inner_lr], 'weight_decay': 0.0}]
+
+    def init_precision(self):
+        if self.hparams.fp32_sine:
+            fp32_first_layers(self.module)
+
+    def autocast(self):
+        """Autocast context for the configured `precision`"""
+        assert self.hparams.precision in precisions, \
+            f'precision must be one of {list(precisions)}'
+        dtype = precisions[self.hparams.precision]
+        return torch.autocast(self.device.type, dtype = dtype,
+                              enabled = dtype != torch.float32)
 
     def initialize_modulation(self):
         m = LatentModulation(self.module.mod,
@@ -36,41 +165,208 @@ class ImplicitNeuralField(pl.LightningModule):
         return make_functional(m)
 
     def initialize_inner_opt(self, mparams):
-        lr = self.hparams.lr_inner
-        opt = torchopt.sgd(lr=lr)
+        if self.hparams.learn_inner_lr:
+            opt = MetaSGD(self)
+        else:
+            lr = self.hparams.lr_inner
+            opt = torchopt.sgd(lr=lr)
         opt_state = opt.init(mparams)
         return (opt, opt_state)
 
     def pred_loss(self, qs: Tensor, ys: Tensor, pred_ys: Tensor):
-        return mse_loss(pred_ys, ys)
+        return mse_loss(pred_ys.float(), ys)
 
     def backward(self, loss, optimizer, optimizer_idx):
-        loss.backward()   # average loss of all modulations
-        optimizer.step()  # outer optimizer
-        torch.cuda.empty_cache()
+        with self.step_profile.section('backward'):
+            loss.backward()   # average loss of all modulations
+        with self.step_profile.section('optimizer'):
+            optimizer.step()  # outer optimizer
+        if self.hparams.empty_cache and self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def meta_loss(self, qs:Tensor, ys:Tensor):
+        """Meta-training objective and loss for a batch of tasks
+
+        The objective is what is differentiated. It only differs
+        from the loss for `meta_grad = 'implicit'`.
+        """
+        with self.autocast():
+            mode = self.hparams.meta_grad
+            assert mode in meta_grad_modes, \
+                f'meta_grad must be one of {meta_grad_modes}'
+            if self.hparams.compile_inner:
+                # one graph, fit and evaluation cannot be told apart
+                with self.step_profile.section('inner_fit'):
+                    loss = compiled_modulation_loop(self, qs, ys)
+                return loss, loss
+            if mode == 'implicit':
+                vloss = vmap(partial(implicit_modulation_loop, self))
+                objective, loss = vloss(qs, ys)
+                return torch.mean(objective), torch.mean(loss)
+            if mode == 'full' and self.checkpoint_steps:
+                loss = checkpointed_modulation_loop(self, qs, ys)
+                return loss, loss
+            # Fitting modulations for current generation
+            # In parallel, trains one mod per task.
+            vloss = vmap(partial(inner_modulation_loop, self))
+
+            # fit modulations on batch - returns averaged loss
+            # Compute the maml loss by summing together the returned losses.
+            loss = torch.mean(vloss(qs, ys))
+            return loss, loss
 
     def training_step(self, batch, batch_idx, optimizer_idx = 0):
         # each task in the batch is a group of queries and outputs
         qs, ys = batch
-        # Fitting modulations for current generation
-        # In parallel, trains one mod per task.
-        vloss = vmap(partial(inner_modulation_loop, self))
-
-        # fit modulations on batch - returns averaged loss
-        # Compute the maml loss by summing together the returned losses.
-        mod_losses = torch.mean(vloss(qs, ys))
-        self.log('loss', mod_losses.item())
-        return mod_losses # overriding `backward`. See above
+        # `meta_loss` times the inner fit and final evaluation
+        objective, mod_losses = self.meta_loss(qs, ys)
+        # logged as a tensor, reduced by the logger. The per-step value
+        # is rank-local; `train_loss` is reduced across ranks once per
+        # epoch, so steps do not block on an all-reduce
+        self.log('loss', mod_losses.detach(), batch_size = qs.shape[0])
+        self.log('train_loss', mod_losses.detach(),
+                 batch_size = qs.shape[0], on_step = False,
+                 on_epoch = True, sync_dist = True)
+        return objective # overriding `backward`. See above
 
     def fit_modulation(self, qs:Tensor, ys:Tensor):
-        return fit_modulation(self, qs, ys)
+        m, _ = self.fit_modulation_steps(qs, ys)
+        return m
+
+    def fit_modulation_steps(self, qs:Tensor, ys:Tensor, key = None):
+        """Fits a single trial, also returning the inner steps taken"""
+        keys = None if key is None else [key]
+        m, steps = self.fit_modulations(qs.unsqueeze(0),
+                                        ys.unsqueeze(0),
+                                        keys = keys)
+        return select_modulation(m, 0), steps[0]
+
+    def fit_modulations(self, qs:Tensor, ys:Tensor, keys = None):
+        """Fits a batch of trials outside of meta-training
+
+        If `keys` are given and the modulation cache is enabled,
+        each trial starts from its cached code.
+
+        Returns the batched modulation and inner steps per trial.
+        """
+        cache = self.mod_cache if not keys is None else None
+        (mfunc, init) = self.initialize_modulation()
+        b = qs.shape[0]
+        mparams = tuple(p.detach().expand(b, *p.shape).clone()
+                        for p in init)
+        if not cache is None:
+            for i, key in enumerate(keys):
+                code = cache.get(key)
+                if code is None:
+                    continue
+                for (p, c) in zip(mparams, code):
+                    p[i] = c
+        if self.hparams.inner_tol > 0:
+            with self.autocast():
+                m, steps = fit_modulation_tol(self, qs, ys,
+                                              mparams = mparams)
+        else:
+            fit = lambda q, y, p: fit_modulation(self, q, y,
+                                                 mparams = p)[1]
+            with self.autocast():
+                mparams = vmap(fit)(qs, ys, mparams)
+            m = (mfunc, tuple(p.detach() for p in mparams))
+            steps = torch.full((b,), self.hparams.inner_steps,
+                               device = qs.device)
+        if not cache is None:
+            for i, key in enumerate(keys):
+                cache.put(key, select_modulation(m, i)[1])
+        return m, steps
+
+    def eval_batch(self, batch, batch_idx:int, stage:str):
+        """Fits and evaluates each trial of an evaluation batch
+
+        Logs the average loss and inner steps for `stage`.
+        Returns per-trial losses, modulations, predictions
+        and inner steps.
+        """
+        (qs, ys) = batch
+        b = qs.shape[0]
+        keys = [(stage, batch_idx, i) for i in range(b)]
+        with self.step_profile.section('inner_fit'):
+            m, steps = self.fit_modulations(qs, ys, keys = keys)
+        (mfunc, mparams) = m
+        veval = vmap(lambda p, q: eval_modulation(self, (mfunc, p), q))
+        with self.step_profile.section('eval'), self.autocast():
+            pred = veval(mparams, qs).float().detach()
+        losses = vmap(self.pred_loss)(qs, ys, pred).detach()
+        self.log(f'{stage}_loss', losses.mean(), batch_size = b,
+                 sync_dist = True)
+        self.log(f'{stage}_inner_steps', steps.float().mean(),
+                 batch_size = b, sync_dist = True)
+        mods = [select_modulation(m, i) for i in range(b)]
+        to_host = self.step_profile.to_host
+        return to_host(losses), mods, pred, to_host(steps)
+
+    def eval_step(self, batch, batch_idx, stage:str):
+        losses, mods, pred, steps = self.eval_batch(batch, batch_idx,
+                                                    stage)
+        return {'loss' : losses,
+                'mod' : mods,
+                'steps' : steps,
+                'pred' : self.step_profile.to_host(pred)}
+
+    @torch.enable_grad()
+    @torch.inference_mode(False)
+    def test_step(self, batch, batch_idx):
+        return self.eval_step(batch, batch_idx, 'test')
+
+    @torch.enable_grad()
+    @torch.inference_mode(False)
+    def validation_step(self, batch, batch_idx):
+        return self.eval_step(batch, batch_idx, 'val')
+
+    @property
+    def checkpoint_steps(self):
+        steps = self.hparams.checkpoint_steps
+        if steps is None:
+            return []
+        if steps == 'all':
+            return list(range(self.hparams.inner_steps))
+        return list(steps)
+
+    @property
+    def step_profile(self):
+        """Section timings read by `ProfileMetaTraining`"""
+        if not hasattr(self, '_step_profile'):
+            self._step_profile = StepProfile()
+        return self._step_profile
+
+    @property
+    def mod_cache(self):
+        if not self.hparams.mod_cache_size > 0:
+            return None
+        if not hasattr(self, '_mod_cache'):
+            self._mod_cache = ModulationCache(self.hparams.mod_cache_size,
+                                              self.hparams.mod_cache_tol,
+                                              self.hparams.mod_cache_decay)
+        return self._mod_cache
+
+    def refresh_mod_cache(self):
+        if not self.mod_cache is None:
+            self.mod_cache.refresh(self.module.parameters())
+
+    def on_validation_epoch_start(self):
+        self.refresh_mod_cache()
+
+    def on_test_epoch_start(self):
+        self.refresh_mod_cache()
 
     def eval_modulation(self, m, qs:Tensor):
         return eval_modulation(self, m, qs)
 
     def configure_optimizers(self):
 
-        optimizer = optim.Adam(self.module.theta.parameters(),
+        params = [
+            {'params': self.module.theta.parameters()},
+            *self.inner_lr_params(),
+        ]
+        optimizer = optim.Adam(params,
                                lr=self.hparams.lr,
                                weight_decay=self.hparams.weight_decay)
         gamma = self.hparams.sched_gamma
@@ -79,6 +375,94 @@ class ImplicitNeuralField(pl.LightningModule):
         return [optimizer], [scheduler]
 
 
+precisions = {
+    'float32' : torch.float32,
+    'bfloat16' : torch.bfloat16,
+}
+
+class MetaSGD:
+    """SGD with learned per-dimension inner learning rates
+
+    Follows the `init`/`update` interface of torchopt optimizers.
+    The state is the step count, used to select per-step rates
+    (see `ImplicitNeuralField.inner_lr_at`). Updates remain
+    differentiable with respect to the rates.
+    """
+
+    def __init__(self, exp):
+        self.exp = exp
+
+    def init(self, params):
+        return 0
+
+    def update(self, grads, state:int, inplace:bool = False):
+        lr = self.exp.inner_lr_at(state)
+        updates = tuple(-lr * g for g in grads)
+        return updates, state + 1
+
+
+class ModulationCache:
+    """LRU cache of fitted modulation parameters
+
+    Codes are keyed by trial (e.g. `(stage, index)`) and used to
+    warm-start later fits of the same trial. Since codes are only
+    meaningful for the outer weights they were fit with, `refresh`
+    clears (or decays) the cache once the weights have drifted.
+
+    Arguments:
+        size: int, maximum number of cached codes
+        tol: float, relative change in outer weights that
+            invalidates the cache
+        decay: float = 0.0, scale applied to codes on invalidation
+            (0 clears the cache)
+    """
+
+    def __init__(self, size:int, tol:float, decay:float = 0.0):
+        self.size = size
+        self.tol = tol
+        self.decay = decay
+        self.codes = OrderedDict()
+        self.reference = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, key):
+        if not key in self.codes:
+            return None
+        self.codes.move_to_end(key)
+        return self.codes[key]
+
+    def put(self, key, mparams):
+        self.codes[key] = tuple(p.detach() for p in mparams)
+        self.codes.move_to_end(key)
+        while len(self.codes) > self.size:
+            self.codes.popitem(last = False)
+
+    def clear(self):
+        self.codes.clear()
+
+    def refresh(self, params):
+        """Invalidates codes if `params` drifted past `tol`"""
+        flat = torch.cat([p.detach().reshape(-1) for p in params])
+        if self.reference is None:
+            self.reference = flat.clone()
+            return
+        ref = self.reference.to(flat.device)
+        drift = torch.linalg.vector_norm(flat - ref) / \
+            torch.linalg.vector_norm(ref).clamp_min(1e-8)
+        if drift.item() <= self.tol:
+            return
+        if self.decay > 0:
+            for k, mparams in self.codes.items():
+                self.codes[k] = tuple(self.decay * p for p in mparams)
+        else:
+            self.clear()
+        self.reference = flat.clone()
+
+
+meta_grad_modes = ['full', 'first_order', 'implicit']
+
 def eval_modulation(exp, mod, qs : Tensor):
     (mfunc, mparams) = mod
     phi = mfunc(mparams)
@@ -87,10 +471,13 @@ def eval_modulation(exp, mod, qs : Tensor):
 # https://github.com/metaopt/torchopt/blob/main/examples/FuncTorch/maml_omniglot_vmap.py
 # borrowed from above
 def fit_modulation(exp, qs: Tensor, ys: Tensor,
-                   inner_steps = None):
+                   inner_steps = None, mparams = None,
+                   first_order:bool = False):
 
     # modulation in functorch form
-    (mfunc, mparams) = exp.initialize_modulation()
+    (mfunc, init) = exp.initialize_modulation()
+    # optionally warm-start
+    mparams = init if mparams is None else mparams
     # init inner loop optimizer
     opt, opt_state = exp.initialize_inner_opt(mparams)
 
@@ -106,6 +493,9 @@ def fit_modulation(exp, qs: Tensor, ys: Tensor,
     new_mparams = mparams
     for _ in range(steps):
         grads = grad(compute_loss)(new_mparams)
+        if first_order:
+            # no second-order terms through the inner updates
+            grads = tuple(g.detach() for g in grads)
         updates, opt_state = opt.update(grads, opt_state,
                                         inplace=False)
         new_mparams = torchopt.apply_updates(new_mparams, updates,
@@ -113,16 +503,247 @@ def fit_modulation(exp, qs: Tensor, ys: Tensor,
 
     return (mfunc, new_mparams)
 
+def select_modulation(mod, idx:int):
+    """Extracts the modulation of a single task from a batch"""
+    (mfunc, mparams) = mod
+    return (mfunc, tuple(p[idx] for p in mparams))
+
+def fit_modulation_tol(exp, qs: Tensor, ys: Tensor,
+                       tol:float = None, max_steps:int = None,
+                       mparams = None):
+    """Fits a batch of modulations with per-task early stopping
+
+    Intended for fitting without an outer gradient (validation,
+    testing, code extraction). Each step, tasks whose prediction loss
+    is within `tol` are masked from further updates. The loop ends
+    once every task has converged or after `max_steps`.
+
+    `mparams` optionally warm-starts the batch.
+
+    Returns the batched modulation and the number of updates
+    applied to each task.
+    """
+    tol = exp.hparams.inner_tol if tol is None else tol
+    if max_steps is None:
+        max_steps = exp.hparams.max_inner_steps
+    if max_steps is None:
+        max_steps = exp.hparams.inner_steps
+
+    (mfunc, init) = exp.initialize_modulation()
+    b = qs.shape[0]
+    if mparams is None:
+        mparams = tuple(p.detach().expand(b, *p.shape).clone()
+                        for p in init)
+    else:
+        mparams = tuple(p.detach() for p in mparams)
+    # updates are elementwise so the optimizer acts on the batch
+    opt, opt_state = exp.initialize_inner_opt(mparams)
+
+    def compute_loss(mparams, qs, ys):
+        m = (mfunc, mparams)
+        pred = eval_modulation(exp, m, qs)
+        pred_loss = exp.pred_loss(qs, ys, pred)
+        l2_loss = torch.sum(mparams[0] ** 2)
+        return pred_loss + l2_loss, pred_loss
+
+    vgrad = vmap(grad(compute_loss, has_aux = True))
+    steps = torch.zeros(b, dtype = torch.long, device = qs.device)
+    for _ in range(max_steps):
+        grads, pred_loss = vgrad(mparams, qs, ys)
+        active = pred_loss > tol
+        # single host sync per step
+        any_active = torch.any(active)
+        exp.step_profile.sync(any_active)
+        if not any_active:
+            break
+        updates, opt_state = opt.update(grads, opt_state,
+                                        inplace=False)
+        new_mparams = torchopt.apply_updates(mparams, updates,
+                                             inplace=False)
+        mparams = tuple(
+            torch.where(active.view(-1, *[1] * (p.dim() - 1)),
+                        n, p).detach()
+            for (n, p) in zip(new_mparams, mparams))
+        steps += active
+
+    return (mfunc, mparams), steps
+
 def fit_and_eval(exp, qs:Tensor, ys:Tensor):
     m = fit_modulation(exp, qs, ys)
     pred = eval_modulation(exp, m, qs)
     return pred
 
 def inner_modulation_loop(exp, qs: Tensor, ys: Tensor):
-    m = fit_modulation(exp, qs, ys)
+    first_order = exp.hparams.meta_grad == 'first_order'
+    with exp.step_profile.section('inner_fit'):
+        m = fit_modulation(exp, qs, ys, first_order = first_order)
     # The final set of adapted parameters will induce some
     # final loss and accuracy on the query dataset.
     # These will be used to update the model's meta-parameters.
-    pred = eval_modulation(exp, m, qs)
-    pred_loss = exp.pred_loss(qs, ys, pred)
+    with exp.step_profile.section('eval'):
+        pred = eval_modulation(exp, m, qs)
+        pred_loss = exp.pred_loss(qs, ys, pred)
     return pred_loss
+
+def checkpointed_modulation_loop(exp, qs: Tensor, ys: Tensor):
+    """Meta-training loss with activation checkpointing
+
+    The inner loop runs outside of `vmap`, with each step vmapped
+    over the batch, so that individual steps can be wrapped in
+    (reentrant) checkpoints. Activations of the module inside the
+    steps listed in `exp.checkpoint_steps` are recomputed during the
+    outer backward instead of being stored. The meta-gradient is
+    unchanged, including second-order terms.
+    """
+    (mfunc, init) = exp.initialize_modulation()
+    b = qs.shape[0]
+    mparams = tuple(p.expand(b, *p.shape) for p in init)
+    opt, opt_state = exp.initialize_inner_opt(mparams)
+
+    def compute_loss(mparams, qs, ys):
+        m = (mfunc, mparams)
+        pred = eval_modulation(exp, m, qs)
+        pred_loss = exp.pred_loss(qs, ys, pred)
+        l2_loss = torch.sum(mparams[0] ** 2)
+        return pred_loss + l2_loss
+
+    vgrad = vmap(grad(compute_loss))
+
+    # optimizer state before each step, so that recomputed
+    # steps start from the same state
+    states = [opt_state]
+
+    # `anchor` only marks the step as requiring grad so that
+    # recomputation also reaches the module parameters
+    def step(i, anchor, *mparams):
+        grads = vgrad(mparams, qs, ys)
+        updates, state = opt.update(grads, states[i], inplace=False)
+        if len(states) == i + 1:
+            states.append(state)
+        return torchopt.apply_updates(mparams, updates, inplace=False)
+
+    anchor = torch.ones((), device = qs.device, requires_grad = True)
+    ckpt_steps = exp.checkpoint_steps
+    with exp.step_profile.section('inner_fit'):
+        for i in range(exp.hparams.inner_steps):
+            if i in ckpt_steps:
+                mparams = checkpoint(partial(step, i), anchor, *mparams,
+                                     use_reentrant = True)
+            else:
+                mparams = step(i, anchor, *mparams)
+            mparams = tuple(mparams)
+
+    with exp.step_profile.section('eval'):
+        veval = vmap(lambda p, q: eval_modulation(exp, (mfunc, p), q))
+        pred = veval(mparams, qs)
+        pred_loss = vmap(exp.pred_loss)(qs, ys, pred)
+    return torch.mean(pred_loss)
+
+def conjugate_gradient(hvp, b: Tensor, steps:int):
+    """Solves `hvp(x) = b` with a fixed number of CG iterations
+
+    The iteration count is static so that the solve can be vmapped.
+    """
+    x = torch.zeros_like(b)
+    r = b
+    p = r
+    rs = torch.sum(r * r)
+    for _ in range(steps):
+        hp = hvp(p)
+        alpha = rs / (torch.sum(p * hp) + 1e-12)
+        x = x + alpha * p
+        r = r - alpha * hp
+        rs_new = torch.sum(r * r)
+        p = r + (rs_new / (rs + 1e-12)) * p
+        rs = rs_new
+    return x
+
+def implicit_modulation_loop(exp, qs: Tensor, ys: Tensor):
+    """Implicit meta-gradient through the inner fit
+
+    Treating the fitted code `z` as a minimizer of the inner loss,
+    dL/dtheta = dL_out/dtheta - d/dtheta [dL_in/dz . v]
+    where `v` solves `H v = dL_out/dz` for the inner Hessian `H`.
+    The solve happens in the latent space and the inner steps
+    are not kept in the graph.
+
+    Returns the surrogate objective (with the correct gradient)
+    and the prediction loss.
+    """
+    with exp.step_profile.section('inner_fit'):
+        (mfunc, mparams) = fit_modulation(exp, qs, ys, first_order = True)
+    z = mparams[0].detach()
+
+    def outer_loss(z):
+        pred = eval_modulation(exp, (mfunc, (z,)), qs)
+        return exp.pred_loss(qs, ys, pred)
+
+    def inner_loss(z):
+        return outer_loss(z) + torch.sum(z ** 2)
+
+    inner_grad = grad(inner_loss)
+    damping = exp.hparams.cg_damping
+
+    def hvp(v):
+        _, hv = jvp(inner_grad, (z,), (v,))
+        return hv.detach() + damping * v
+
+    with exp.step_profile.section('implicit_solve'):
+        g_out = grad(outer_loss)(z).detach()
+        v = conjugate_gradient(hvp, g_out, exp.hparams.cg_steps)
+    with exp.step_profile.section('eval'):
+        pred_loss = outer_loss(z)
+        objective = pred_loss - torch.sum(inner_grad(z) * v.detach())
+    return objective, pred_loss
+
+
+def functional_modulation_loop(exp, qs: Tensor, ys: Tensor):
+    """Traceable version of `inner_modulation_loop`
+
+    The modulation is a plain latent tensor updated with SGD
+    (matching `initialize_inner_opt`) so that the inner loop
+    contains only `torch.func` transforms.
+    """
+    first_order = exp.hparams.meta_grad == 'first_order'
+    m = torch.zeros(exp.module.mod, device = qs.device,
+                    dtype = qs.dtype)
+
+    def compute_loss(m):
+        pred = exp.module(qs, m)
+        pred_loss = exp.pred_loss(qs, ys, pred)
+        l2_loss = torch.sum(m ** 2)
+        return pred_loss + l2_loss
+
+    for i in range(exp.hparams.inner_steps):
+        g = torch.func.grad(compute_loss)(m)
+        if first_order:
+            g = g.detach()
+        m = m - exp.inner_lr_at(i) * g
+
+    pred = exp.module(qs, m)
+    return exp.pred_loss(qs, ys, pred)
+
+def batch_modulation_loss(exp, qs: Tensor, ys: Tensor):
+    vloss = torch.func.vmap(partial(functional_modulation_loop, exp))
+    return torch.mean(vloss(qs, ys))
+
+def compiled_modulation_loop(exp, qs: Tensor, ys: Tensor):
+    """Meta-training loss through a compiled graph
+
+    The inner loop, `vmap` over tasks and (through AOTAutograd)
+    the outer backward are traced together. One graph is
+    compiled and cached per input shape.
+    Supports the 'full' and 'first_order' meta-gradients and
+    learned (per-step) inner rates, but not `checkpoint_steps`
+    (see `ImplicitNeuralField.check_hparams`).
+    """
+    if not hasattr(exp, '_compiled_loops'):
+        exp._compiled_loops = {}
+    key = (tuple(qs.shape), tuple(ys.shape), qs.device)
+    if not key in exp._compiled_loops:
+        f = partial(batch_modulation_loss, exp)
+        exp._compiled_loops[key] = torch.compile(
+            f,
+            backend = exp.hparams.compile_backend,
+            dynamic = False)
+    return exp._compiled_loops[key](qs, ys)
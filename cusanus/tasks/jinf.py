@@ -0,0 +1,174 @@
+import jax
+import optax
+import equinox as eqx
+import jax.numpy as jnp
+from jax import Array, lax
+
+from cusanus.archs.siren import ImplicitNeuralModule
+
+
+class JaxNeuralField:
+    """Meta-learns an Equinox ImplicitNeuralModule in JAX
+
+    Mirrors `ImplicitNeuralField`: modulations are fit with SGD in
+    an inner loop (`lax.scan`), tasks are fit in parallel with
+    `vmap` and the whole outer step (inner loops, meta-gradient and
+    optax update) is a single jitted program.
+
+    Only the Siren weights (`theta`) are meta-learned.
+
+    Arguments:
+        module: ImplicitNeuralModule, INR architecture
+        inner_steps: int = 5
+        lr: float = 0.001, learning rate
+        lr_inner: float = 0.001
+        weight_decay: float = 0.001
+        sched_gamma: float = 0.8, learning rate decay per epoch
+        checkpoint_inner: bool = False, recompute inner step
+            activations during the outer backward. Per-layer
+            checkpointing is set on the module
+            (`SirenNet(checkpoint_layers = ...)`)
+    """
+
+    def __init__(self,
+                 module: ImplicitNeuralModule,
+                 inner_steps:int = 5,
+                 lr:float = 0.001,
+                 lr_inner:float = 0.001,
+                 weight_decay:float = 0.001,
+                 sched_gamma:float = 0.8,
+                 checkpoint_inner:bool = False) -> None:
+        self.hparams = dict(inner_steps = inner_steps,
+                            lr = lr,
+                            lr_inner = lr_inner,
+                            weight_decay = weight_decay,
+                            sched_gamma = sched_gamma,
+                            checkpoint_inner = checkpoint_inner)
+        self.module = module
+        self.filter_spec = theta_filter(module)
+        self.optimizer = optax.inject_hyperparams(optax.adamw)(
+            learning_rate = lr,
+            weight_decay = weight_decay)
+        self.opt_state = self.optimizer.init(
+            eqx.filter(module, self.filter_spec))
+
+    @property
+    def inner_params(self):
+        return dict(inner_steps = self.hparams['inner_steps'],
+                    lr_inner = self.hparams['lr_inner'],
+                    checkpoint = self.hparams['checkpoint_inner'])
+
+    def meta_loss(self, qs:Array, ys:Array):
+        return meta_loss(self.module, qs, ys, **self.inner_params)
+
+    def training_step(self, batch):
+        """One outer update. Returns the loss without a host sync"""
+        qs, ys = batch
+        self.module, self.opt_state, loss = train_step(
+            self.module, self.opt_state, qs, ys,
+            optimizer = self.optimizer,
+            filter_spec = self.filter_spec,
+            **self.inner_params)
+        return loss
+
+    def on_train_epoch_end(self):
+        hparams = self.opt_state.hyperparams
+        hparams['learning_rate'] = hparams['learning_rate'] * \
+            self.hparams['sched_gamma']
+
+    def fit_modulation(self, qs:Array, ys:Array, m:Array = None):
+        return jit_fit_modulation(self.module, qs, ys, m,
+                                  inner_steps = self.hparams['inner_steps'],
+                                  lr_inner = self.hparams['lr_inner'])
+
+    def fit_modulations(self, qs:Array, ys:Array):
+        """Fits a batch of trials"""
+        return jit_fit_modulations(self.module, qs, ys,
+                                   inner_steps = self.hparams['inner_steps'],
+                                   lr_inner = self.hparams['lr_inner'])
+
+    def eval_modulation(self, m:Array, qs:Array):
+        return jit_eval_modulation(self.module, m, qs)
+
+    def save_checkpoint(self, path:str):
+        eqx.tree_serialise_leaves(path, (self.module, self.opt_state))
+
+    @classmethod
+    def load_checkpoint(cls, path:str, module:ImplicitNeuralModule,
+                        **hparams):
+        """Restores a field saved with `save_checkpoint`
+
+        `module` and `hparams` must describe the saved architecture.
+        """
+        field = cls(module, **hparams)
+        like = (field.module, field.opt_state)
+        field.module, field.opt_state = eqx.tree_deserialise_leaves(path,
+                                                                    like)
+        return field
+
+
+def theta_filter(module:ImplicitNeuralModule):
+    """Filter spec marking the Siren weights as trainable"""
+    spec = jax.tree_util.tree_map(lambda _: False, module)
+    theta = jax.tree_util.tree_map(eqx.is_array, module.theta)
+    return eqx.tree_at(lambda m: m.theta, spec, theta)
+
+def pred_loss(pred:Array, ys:Array):
+    return jnp.mean((pred - ys) ** 2)
+
+def eval_modulation(module:ImplicitNeuralModule, m:Array, qs:Array):
+    return jax.vmap(module, in_axes = (0, None))(qs, m)
+
+def inner_loss(m:Array, module:ImplicitNeuralModule, qs:Array, ys:Array):
+    pred = eval_modulation(module, m, qs)
+    return pred_loss(pred, ys) + jnp.sum(m ** 2)
+
+def fit_modulation(module:ImplicitNeuralModule, qs:Array, ys:Array,
+                   m:Array = None, inner_steps:int = 5,
+                   lr_inner:float = 0.001, checkpoint:bool = False):
+    """Fits the modulation of a single trial with SGD"""
+    m = jnp.zeros(module.mod) if m is None else m
+
+    def step(m, _):
+        g = jax.grad(inner_loss)(m, module, qs, ys)
+        return m - lr_inner * g, None
+
+    if checkpoint:
+        step = jax.checkpoint(step)
+    m, _ = lax.scan(step, m, None, length = inner_steps)
+    return m
+
+def task_loss(module:ImplicitNeuralModule, qs:Array, ys:Array, **kwargs):
+    m = fit_modulation(module, qs, ys, **kwargs)
+    pred = eval_modulation(module, m, qs)
+    return pred_loss(pred, ys)
+
+def meta_loss(module:ImplicitNeuralModule, qs:Array, ys:Array, **kwargs):
+    losses = jax.vmap(lambda q, y: task_loss(module, q, y, **kwargs))(qs, ys)
+    return jnp.mean(losses)
+
+@eqx.filter_jit
+def train_step(module:ImplicitNeuralModule, opt_state, qs:Array, ys:Array,
+               optimizer, filter_spec, **kwargs):
+    diff, static = eqx.partition(module, filter_spec)
+
+    def loss_fn(diff):
+        return meta_loss(eqx.combine(diff, static), qs, ys, **kwargs)
+
+    loss, grads = jax.value_and_grad(loss_fn)(diff)
+    updates, opt_state = optimizer.update(grads, opt_state, diff)
+    module = eqx.apply_updates(module, updates)
+    return module, opt_state, loss
+
+@eqx.filter_jit
+def jit_fit_modulation(module, qs, ys, m, **kwargs):
+    return fit_modulation(module, qs, ys, m, **kwargs)
+
+@eqx.filter_jit
+def jit_fit_modulations(module, qs, ys, **kwargs):
+    fit = lambda q, y: fit_modulation(module, q, y, **kwargs)
+    return jax.vmap(fit)(qs, ys)
+
+@eqx.filter_jit
+def jit_eval_modulation(module, m, qs):
+    return eval_modulation(module, m, qs)
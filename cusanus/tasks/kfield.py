@@ -27,51 +27,58 @@ class KField(ImplicitNeuralField):
                  lr:float = 0.001,
                  lr_inner:float = 0.001,
                  weight_decay:float = 0.001,
-                 sched_gamma:float = 0.8) -> None:
+                 sched_gamma:float = 0.8,
+                 compile_inner:bool = False,
+                 compile_backend:str = 'inductor',
+                 inner_tol:float = 0.0,
+                 max_inner_steps:int = None,
+                 mod_cache_size:int = 0,
+                 mod_cache_tol:float = 0.01,
+                 mod_cache_decay:float = 0.0,
+                 meta_grad:str = 'full',
+                 cg_steps:int = 5,
+                 cg_damping:float = 0.0,
+                 checkpoint_steps = None,
+                 learn_inner_lr:bool = False,
+                 per_step_lr:bool = False,
+                 precision:str = 'float32',
+                 fp32_sine:bool = True,
+                 empty_cache:bool = False) -> None:
         super(ImplicitNeuralField, self).__init__()
         self.save_hyperparameters(ignore = 'module')
         self.module = module
+        self.check_hparams()
+        self.init_inner_lr()
+        self.init_precision()
 
-    def pred_loss(self, qs: Tensor, ys: Tensor, pred):
-        pred_ys = pred
-        loss = mse_loss(ys, pred_ys)
-        return loss
+    def frames(self, qs:Tensor):
+        """Shares motion across the frames of `qs`, if it has any
+        (see `KModule.frame_size`)"""
+        return self.module.frames(self.module.frame_size(qs))
 
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def test_step(self, batch, batch_idx):
-        (qs, ys) = batch
-        qs = qs[0]
-        ys = ys[0]
-        m = self.fit_modulation(qs, ys)
-        pred = self.eval_modulation(m, qs)
-        pred_loss = self.pred_loss(qs, ys, pred).detach().cpu()
-        self.log('test_loss', pred_loss)
-        return {'loss' : pred_loss,
-                'mod' : m,
-                'pred':pred.detach().cpu()}
+    def meta_loss(self, qs:Tensor, ys:Tensor):
+        with self.frames(qs):
+            return super().meta_loss(qs, ys)
 
-    @torch.enable_grad()
-    @torch.inference_mode(False)
-    def validation_step(self, batch, batch_idx):
-        (qs, ys) = batch
-        qs = qs[0]
-        ys = ys[0]
-        m = self.fit_modulation(qs, ys)
-        pred = self.eval_modulation(m, qs)
-        pred_loss = self.pred_loss(qs, ys, pred).detach().cpu()
-        self.log('val_loss', pred_loss)
-        return {'loss' : pred_loss,
-                'mod' : m,
-                'pred':pred.detach().cpu()}
+    def fit_modulations(self, qs:Tensor, ys:Tensor, keys = None):
+        with self.frames(qs):
+            return super().fit_modulations(qs, ys, keys = keys)
 
+    def eval_batch(self, batch, batch_idx:int, stage:str):
+        with self.frames(batch[0]):
+            return super().eval_batch(batch, batch_idx, stage)
 
+    def pred_loss(self, qs: Tensor, ys: Tensor, pred):
+        pred_ys = pred
+        loss = mse_loss(ys, pred_ys.float())
+        return loss
 
     def configure_optimizers(self):
 
         params = [
             {'params': self.module.pos_field.theta.parameters()},
             {'params': self.module.motion_field.theta.parameters()},
+            *self.inner_lr_params(),
         ]
         optimizer = optim.Adam(params,
                                lr=self.hparams.lr,
@@ -2,3 +2,9 @@ from . coordinates import (grids_along_depth,
                            grids_along_axis,
                            gfield_grids)
 from . visualization import (RenderKFieldVolumes)
+from . profiling import (ProfileMetaTraining, StepProfile)
+from . evaluation import (LazyGrid, motion_grid, evaluate_field)
+from . refinement import (Refinement, refine_field, marching_squares)
+from . baking import (BakedField, BakeCache, bake_field)
+from . distributed import (FFCVDataModule, cpu_ddp, pin_threads,
+                           shard_loader_params)
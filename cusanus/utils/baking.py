@@ -0,0 +1,116 @@
+import itertools
+import numpy as np
+import torch
+from torch import nn
+from collections import OrderedDict
+
+from cusanus.pytypes import *
+from cusanus.utils.evaluation import (LazyGrid, evaluate_field,
+                                     module_frames)
+
+
+class BakedField(nn.Module):
+    """A fitted field sampled on a regular grid
+
+    Queries are answered by multilinear (bi- or trilinear)
+    interpolation of the grid. Dimensions with a single sample
+    are constant. `error` is the largest absolute deviation from
+    the network found at random check points.
+    """
+
+    def __init__(self, lo:Tensor, hi:Tensor, values:Tensor,
+                 error:float = None):
+        super().__init__()
+        self.register_buffer('lo', lo)
+        self.register_buffer('hi', hi)
+        # r_1 x ... x r_d x out
+        self.register_buffer('values', values)
+        self.error = error
+
+    @property
+    def res(self):
+        return torch.tensor(self.values.shape[:len(self.lo)],
+                            device = self.values.device)
+
+    def forward(self, qs:Tensor):
+        d = len(self.lo)
+        res = self.res
+        span = (self.hi - self.lo).clamp_min(1e-12)
+        u = (qs - self.lo) / span * (res - 1)
+        u = torch.minimum(u.clamp_min(0), res - 1)
+        i0 = torch.minimum(u.floor().long(), (res - 2).clamp_min(0))
+        w = u - i0
+        out = 0.
+        for corner in itertools.product([0, 1], repeat = d):
+            c = torch.tensor(corner, device = qs.device)
+            weight = torch.prod(torch.where(c == 1, w, 1 - w), dim = 1)
+            # single sample dimensions have w = 0, so the clamped
+            # upper corner gets no weight
+            idx = torch.minimum(i0 + c, res - 1)
+            v = self.values[tuple(idx.T)]
+            out = out + weight.unsqueeze(1) * v
+        return out
+
+
+def bake_field(exp, m, lo:Tuple[float, ...], hi:Tuple[float, ...],
+               res:Tuple[int, ...], n_check:int = 1024,
+               budget_mib:float = 256.0):
+    """Samples a fitted modulation `m` on a `res` grid over [lo, hi]
+
+    For GField use an x-y domain, for KField t-x-y. A `KModule`
+    shares each grid time across its frame and evaluates the random
+    check points with one time per query.
+    """
+    lo = torch.tensor(lo, dtype = torch.float32)
+    hi = torch.tensor(hi, dtype = torch.float32)
+    axes = [torch.linspace(a, b, steps = r) for (a, b, r) in
+            zip(lo.tolist(), hi.tolist(), res)]
+    grid = LazyGrid(*axes)
+    frame = int(np.prod(res[1:]))
+    with module_frames(exp, frame):
+        ys, _ = evaluate_field(exp, m, grid, budget_mib = budget_mib,
+                               align = frame)
+    values = torch.from_numpy(ys).reshape(*res, -1)
+    baked = BakedField(lo, hi, values)
+    if n_check > 0:
+        qs = lo + torch.rand(n_check, len(res)) * (hi - lo)
+        with module_frames(exp, 1):
+            true, _ = evaluate_field(exp, m, qs, budget_mib = budget_mib)
+        err = torch.abs(baked(qs) - torch.from_numpy(true))
+        baked.error = err.max().item()
+    return baked
+
+
+class BakeCache:
+    """LRU cache of baked fields
+
+    Keyed by the module, the version of its parameters (bumped by
+    every in-place update, e.g. an optimizer step or
+    `load_state_dict`) and the modulation code.
+    """
+
+    def __init__(self, size:int = 128):
+        self.size = size
+        self.fields = OrderedDict()
+
+    @staticmethod
+    def key(exp, m, *args):
+        (mfunc, mparams) = m
+        code = mfunc(mparams).detach().cpu().numpy()
+        version = tuple((id(p), p._version)
+                        for p in exp.module.parameters())
+        return (id(exp.module), version, code.tobytes(), *args)
+
+    def bake(self, exp, m, lo, hi, res, **kwargs):
+        key = self.key(exp, m, tuple(lo), tuple(hi), tuple(res))
+        if key in self.fields:
+            self.fields.move_to_end(key)
+            return self.fields[key]
+        baked = bake_field(exp, m, lo, hi, res, **kwargs)
+        self.fields[key] = baked
+        if len(self.fields) > self.size:
+            self.fields.popitem(last = False)
+        return baked
+
+    def clear(self):
+        self.fields.clear()
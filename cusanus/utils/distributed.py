@@ -0,0 +1,100 @@
+import os
+import torch
+import torch.distributed as dist
+from pytorch_lightning import LightningDataModule
+from pytorch_lightning.strategies import DDPStrategy
+
+from cusanus.pytypes import *
+
+# cores available to the launching process, inherited by the ranks
+# that lightning starts (before rank 0 pins itself)
+CORES_ENV = 'CUSANUS_CORES'
+
+def local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def rank_cores(nprocs:int, rank:int = None) -> List[int]:
+    """Contiguous slice of the node's cores owned by `rank`"""
+    rank = local_rank() if rank is None else rank
+    if not CORES_ENV in os.environ:
+        cores = sorted(os.sched_getaffinity(0))
+        os.environ[CORES_ENV] = ','.join(map(str, cores))
+    cores = [int(c) for c in os.environ[CORES_ENV].split(',')]
+    n = max(len(cores) // nprocs, 1)
+    return cores[rank * n : (rank + 1) * n] or cores[-n:]
+
+def pin_threads(nprocs:int, rank:int = None) -> int:
+    """Restricts this process to its share of the cores
+
+    Sets the affinity and torch / OpenMP thread counts so that
+    `nprocs` ranks on one node do not oversubscribe it. Must run
+    before any parallel work (interop threads are fixed after).
+
+    Returns the number of threads.
+    """
+    cores = rank_cores(nprocs, rank)
+    os.sched_setaffinity(0, cores)
+    n = len(cores)
+    os.environ['OMP_NUM_THREADS'] = str(n)
+    torch.set_num_threads(n)
+    try:
+        torch.set_num_interop_threads(1 if nprocs > 1 else n)
+    except RuntimeError:
+        # already set (e.g. when called twice in a process)
+        pass
+    return n
+
+def shard_loader_params(params:dict, nprocs:int) -> dict:
+    """Per-rank loader parameters
+
+    The global batch size of the config is split across ranks so
+    that each outer step sees the same number of trials, and
+    loader workers share the cores of the rank.
+    """
+    params = dict(params)
+    params['batch_size'] = max(params['batch_size'] // nprocs, 1)
+    if 'num_workers' in params:
+        params['num_workers'] = max(params['num_workers'] // nprocs, 1)
+    return params
+
+def cpu_ddp(nprocs:int, task) -> dict:
+    """`Trainer` arguments for `nprocs` gloo DDP ranks on CPU
+
+    Unused parameter detection follows the task's
+    `ddp_find_unused_parameters`. With one process the trainer
+    is left as is.
+    """
+    if nprocs <= 1:
+        return {'accelerator' : 'auto'}
+    find_unused = getattr(task, 'ddp_find_unused_parameters', True)
+    strategy = DDPStrategy(process_group_backend = 'gloo',
+                           find_unused_parameters = find_unused)
+    return {'accelerator' : 'cpu',
+            'devices' : nprocs,
+            'strategy' : strategy,
+            # ffcv loaders shard themselves (see `FFCVDataModule`)
+            'replace_sampler_ddp' : False}
+
+
+class FFCVDataModule(LightningDataModule):
+    """Builds ffcv loaders once the process group exists
+
+    `train` and `val` are called with `distributed`, which is set
+    when running under DDP so that each rank reads its own shard.
+    ffcv requires the process group at construction, hence the
+    loaders cannot be built before `Trainer.fit`.
+    """
+
+    def __init__(self, train:Callable, val:Callable):
+        super().__init__()
+        self.train = train
+        self.val = val
+
+    def train_dataloader(self):
+        return self.train(distributed = is_distributed())
+
+    def val_dataloader(self):
+        return self.val(distributed = is_distributed())
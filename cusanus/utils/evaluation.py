@@ -0,0 +1,101 @@
+import time
+import contextlib
+import numpy as np
+import torch
+from torch import nn
+
+from cusanus.pytypes import *
+
+
+class LazyGrid:
+    """Cartesian product of 1D axes, materialized one chunk at a time
+
+    Rows are ordered as in `torch.cartesian_prod` (last axis fastest).
+    """
+
+    def __init__(self, *axes:Tensor):
+        self.axes = axes
+        self.shape = tuple(len(a) for a in axes)
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def qsize(self):
+        return len(self.axes)
+
+    def chunk(self, start:int, stop:int):
+        idx = torch.arange(start, stop)
+        cols = []
+        for (a, n) in zip(reversed(self.axes), reversed(self.shape)):
+            cols.append(a[idx % n])
+            idx = idx // n
+        return torch.stack(cols[::-1], dim = 1)
+
+def motion_grid(nt : int, trange : Tuple[float, float],
+                nx : int, xrange : Tuple[float, float],
+                ny : int, yrange : Tuple[float, float]):
+    """Lazy (t, x, y) grid, frame-major"""
+    return LazyGrid(torch.linspace(*trange, steps = nt),
+                    torch.linspace(*xrange, steps = nx),
+                    torch.linspace(*yrange, steps = ny))
+
+def module_frames(exp, k_per_frame:int):
+    """`exp.module.frames(k_per_frame)` for modules that share times
+    across queries (`KModule`), a no-op otherwise"""
+    frames = getattr(exp.module, 'frames', None)
+    if frames is None:
+        return contextlib.nullcontext()
+    return frames(k_per_frame)
+
+def bytes_per_query(module:nn.Module):
+    """Rough activation memory (bytes) of evaluating one query
+
+    Counts the output width of every weight matrix twice (pre and
+    post activation) in float32.
+    """
+    widths = sum(p.shape[0] for p in module.parameters() if p.dim() == 2)
+    return 2 * 4 * max(widths, 1)
+
+def chunk_size(exp, budget_mib:float, align:int = 1):
+    """Number of queries per chunk that fits within `budget_mib`"""
+    n = int(budget_mib * 2**20 // bytes_per_query(exp.module))
+    return max(n // align, 1) * align
+
+@torch.no_grad()
+def evaluate_field(exp, m, qs, budget_mib:float = 256.0,
+                   align:int = 1, out_path:str = None):
+    """Evaluates a fitted modulation over many queries in chunks
+
+    Arguments:
+        exp: ImplicitNeuralField
+        m: fitted modulation (see `exp.fit_modulation`)
+        qs: query tensor or `LazyGrid`
+        budget_mib: activation memory allowed per chunk
+        align: chunk sizes are multiples of this (e.g. queries per
+            frame for `KModule`)
+        out_path: when given, the output is a `.npy` memmap there
+
+    Returns the outputs as a numpy array and the points per second.
+    """
+    n = len(qs)
+    k = min(chunk_size(exp, budget_mib, align), n)
+    out = None
+    t0 = time.perf_counter()
+    for start in range(0, n, k):
+        stop = min(start + k, n)
+        chunk = qs.chunk(start, stop) if isinstance(qs, LazyGrid) \
+            else qs[start:stop]
+        ys = exp.eval_modulation(m, chunk.to(exp.device))
+        ys = ys.float().cpu().numpy()
+        if out is None:
+            shape = (n, *ys.shape[1:])
+            out = np.empty(shape, dtype = ys.dtype) if out_path is None \
+                else np.lib.format.open_memmap(out_path, mode = 'w+',
+                                               dtype = ys.dtype,
+                                               shape = shape)
+        out[start:stop] = ys
+    rate = n / (time.perf_counter() - t0)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out, rate
@@ -25,3 +25,40 @@ def sphere_to_bullet(radius:float, pos, cid:int):
 # HACK : specialize using pybullets rect primitive
 def rect_to_bullet(mesh:Trimesh,  cid:int):
     return mesh_to_bullet(mesh, cid)
+
+def local_bounds(loader, geometry):
+    """Bounds (2 x 3) of a body relative to its base position"""
+    if loader is sphere_to_bullet:
+        radius = geometry[0]
+        return np.array([[-radius] * 3, [radius] * 3])
+    # meshes are created in world coordinates at the origin
+    mesh = geometry[0]
+    return np.asarray(mesh.bounds)
+
+def trajectory_aabbs(scene:dict, registry:dict, position:np.ndarray):
+    """Axis aligned box swept by each body over a trajectory
+
+    Returns an (objects x 2 x 3) array indexed by body id.
+    """
+    aabbs = np.empty((position.shape[1], 2, 3))
+    for (k, oid) in registry.items():
+        o = scene[k]
+        bounds = local_bounds(o['loader'], o['geometry'])
+        aabbs[oid, 0] = position[:, oid].min(axis = 0) + bounds[0]
+        aabbs[oid, 1] = position[:, oid].max(axis = 0) + bounds[1]
+    return aabbs
+
+def broadphase_pairs(aabbs:np.ndarray, static:np.ndarray,
+                     margin:float = 0.0):
+    """Pairs of bodies that may come into contact
+
+    Pairs are enumerated as in `itertools.combinations` (the column
+    order of the `collision` record). A pair is kept if its swept
+    boxes overlap within `margin` and at least one body can move.
+
+    Returns a mask over all pairs.
+    """
+    a, b = np.triu_indices(len(aabbs), k = 1)
+    overlap = np.all((aabbs[a, 0] - margin <= aabbs[b, 1]) &
+                     (aabbs[b, 0] - margin <= aabbs[a, 1]), axis = 1)
+    return overlap & ~(static[a] & static[b])
@@ -0,0 +1,199 @@
+import os
+import time
+import resource
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from pytorch_lightning.callbacks import Callback
+
+
+class StepProfile:
+    """Per-step wall time of named sections and host sync count
+
+    Sections are only timed while `enabled`, so the hooks left in
+    the hot path cost a branch otherwise. Times are host floats and
+    are accumulated without touching the device. With `cuda_sync`,
+    each section synchronizes before reading the clock (this is
+    counted as a sync).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.syncs = 0
+
+    def _synchronize(self):
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+            self.syncs += 1
+
+    @contextmanager
+    def section(self, name:str):
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        t0 = time.perf_counter()
+        yield
+        self._synchronize()
+        self.times[name] += time.perf_counter() - t0
+
+    def add(self, name:str, dur:float):
+        if self.enabled:
+            self.times[name] += dur
+
+    def sync(self, *xs:torch.Tensor):
+        """Records reading `xs` on the host
+
+        Only tensors off the host count as synchronizations.
+        """
+        if self.enabled:
+            self.syncs += sum(x.device.type != 'cpu' for x in xs)
+
+    def to_host(self, x:torch.Tensor):
+        """`x.cpu()`, recorded as a sync"""
+        self.sync(x)
+        return x.cpu()
+
+
+def peak_memory():
+    """Peak memory (MiB) of the device or, on CPU, the process"""
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class ProfileMetaTraining(Callback):
+    """Reports where meta-training time goes
+
+    Times the data wait, inner fit, evaluation, outer backward and
+    optimizer step of each training batch through the task's
+    `step_profile`. Every `every_n_steps` the averages, peak memory
+    and sync count are logged under `profile/`. Validation batches
+    are aggregated separately and logged under `profile/val_` at
+    the end of each validation epoch.
+
+    Arguments:
+        every_n_steps: int = 50, reduction (and trace) interval
+        trace_dir: str = None, when given, a torch profiler trace of
+            `trace_steps` steps is exported there every interval
+        trace_steps: int = 1
+        cuda_sync: bool = False, synchronize around sections so that
+            device time is attributed correctly
+    """
+
+    def __init__(self,
+                 every_n_steps:int = 50,
+                 trace_dir:str = None,
+                 trace_steps:int = 1,
+                 cuda_sync:bool = False):
+        super().__init__()
+        self.every_n_steps = every_n_steps
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.cuda_sync = cuda_sync
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.syncs = 0
+        self.steps = 0
+
+    def reset_val(self):
+        self.val_totals = defaultdict(float)
+        self.val_syncs = 0
+        self.val_steps = 0
+
+    def on_train_start(self, trainer, exp):
+        exp.step_profile.enabled = True
+        exp.step_profile.cuda_sync = self.cuda_sync
+        self.last_end = None
+        self.profiler = None
+        self.reset_val()
+        if not self.trace_dir is None:
+            os.makedirs(self.trace_dir, exist_ok = True)
+
+    def on_train_end(self, trainer, exp):
+        exp.step_profile.enabled = False
+        self.stop_trace(trainer)
+
+    def on_train_batch_start(self, trainer, exp, batch, batch_idx):
+        profile = exp.step_profile
+        profile.reset()
+        if not self.last_end is None:
+            profile.add('data', time.perf_counter() - self.last_end)
+        if not self.trace_dir is None and self.profiler is None and \
+           trainer.global_step % self.every_n_steps == 0:
+            self.start_trace(trainer)
+
+    def on_train_batch_end(self, trainer, exp, outputs, batch, batch_idx):
+        profile = exp.step_profile
+        for (k, v) in profile.times.items():
+            self.totals[k] += v
+        self.syncs += profile.syncs
+        self.steps += 1
+        if not self.profiler is None:
+            self.profiler.step()
+            if trainer.global_step >= self.trace_start + self.trace_steps:
+                self.stop_trace(trainer)
+        if self.steps >= self.every_n_steps:
+            metrics = {f'profile/{k}_sec' : v / self.steps
+                       for (k, v) in self.totals.items()}
+            metrics['profile/syncs_per_step'] = self.syncs / self.steps
+            metrics['profile/peak_mib'] = peak_memory()
+            exp.log_dict(metrics, batch_size = 1)
+            self.reset()
+        self.last_end = time.perf_counter()
+
+    def on_validation_start(self, trainer, exp):
+        self.reset_val()
+        # validation time is not waiting on training data
+        self.last_end = None
+
+    def on_validation_batch_start(self, trainer, exp, batch, batch_idx,
+                                  dataloader_idx = 0):
+        exp.step_profile.reset()
+
+    def on_validation_batch_end(self, trainer, exp, outputs, batch,
+                                batch_idx, dataloader_idx = 0):
+        profile = exp.step_profile
+        if not profile.enabled:
+            return
+        for (k, v) in profile.times.items():
+            self.val_totals[k] += v
+        self.val_syncs += profile.syncs
+        self.val_steps += 1
+
+    def on_validation_epoch_end(self, trainer, exp):
+        if self.val_steps == 0:
+            return
+        metrics = {f'profile/val_{k}_sec' : v / self.val_steps
+                   for (k, v) in self.val_totals.items()}
+        metrics['profile/val_syncs_per_batch'] = \
+            self.val_syncs / self.val_steps
+        exp.log_dict(metrics, batch_size = 1)
+
+    def start_trace(self, trainer):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace_start = trainer.global_step
+        self.profiler = torch.profiler.profile(activities = activities,
+                                               profile_memory = True,
+                                               record_shapes = True)
+        self.profiler.start()
+
+    def stop_trace(self, trainer):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        path = os.path.join(self.trace_dir,
+                            f'step_{self.trace_start}.json')
+        self.profiler.export_chrome_trace(path)
+        self.profiler = None
@@ -0,0 +1,124 @@
+import itertools
+import numpy as np
+import torch
+from typing import NamedTuple
+
+from cusanus.pytypes import *
+from cusanus.utils.evaluation import evaluate_field, module_frames
+
+
+class Refinement(NamedTuple):
+    """Leaf cells of an adaptive quadtree / octree
+
+    Cells are axis aligned boxes given in domain coordinates.
+    `values` holds the field at the cell corners, ordered as
+    `itertools.product([0, 1], repeat = d)`.
+    """
+    corners: np.ndarray  # n x d, lower corner
+    sizes: np.ndarray    # n x d
+    values: np.ndarray   # n x 2^d
+    queries: int         # field evaluations used
+    dense_queries: int   # evaluations of the equivalent uniform grid
+
+
+def refine_field(exp, m, lo:Tuple[float, ...], hi:Tuple[float, ...],
+                 base_res:int = 8, max_depth:int = 4,
+                 threshold:float = 0.5, var_tol:float = 0.1,
+                 budget_mib:float = 256.0):
+    """Samples a fitted field with a quadtree (2D) or octree (3D)
+
+    Starts from a `base_res`^d grid of cells and splits a cell while
+    its corner values straddle `threshold` or vary by more than
+    `var_tol`, up to `max_depth` levels. Corners shared between
+    cells are evaluated once. Corners are queried in arbitrary
+    order, so a `KModule` is evaluated with one time per query.
+
+    Arguments:
+        exp: ImplicitNeuralField
+        m: fitted modulation
+        lo, hi: domain bounds per dimension
+    """
+    d = len(lo)
+    lo = np.asarray(lo, dtype = np.float32)
+    hi = np.asarray(hi, dtype = np.float32)
+    # corners live on the integer lattice of the finest level
+    res = base_res * 2 ** max_depth
+    offsets = np.array(list(itertools.product([0, 1], repeat = d)))
+    radix = (res + 1) ** np.arange(d)
+
+    keys = np.empty(0, dtype = np.int64)
+    vals = np.empty(0, dtype = np.float32)
+
+    def corner_values(cells, size):
+        nonlocal keys, vals
+        verts = cells[:, None, :] + offsets[None] * size
+        vkeys = verts.reshape(-1, d) @ radix
+        new = np.setdiff1d(np.unique(vkeys), keys)
+        if len(new):
+            lattice = (new[:, None] // radix) % (res + 1)
+            qs = (lo + lattice / res * (hi - lo)).astype(np.float32)
+            with module_frames(exp, 1):
+                ys, _ = evaluate_field(exp, m, torch.from_numpy(qs),
+                                       budget_mib = budget_mib)
+            keys = np.concatenate([keys, new])
+            vals = np.concatenate([vals, ys.reshape(len(new), -1)[:, 0]])
+            order = np.argsort(keys)
+            keys, vals = keys[order], vals[order]
+        idx = np.searchsorted(keys, vkeys)
+        return vals[idx].reshape(len(cells), -1)
+
+    size = 2 ** max_depth
+    cells = np.array(list(itertools.product(range(base_res), repeat = d)))
+    cells = cells * size
+    leaves = []
+    for level in range(max_depth + 1):
+        v = corner_values(cells, size)
+        vmin, vmax = v.min(axis = 1), v.max(axis = 1)
+        split = ((vmin < threshold) & (vmax > threshold)) | \
+            (vmax - vmin > var_tol)
+        if level == max_depth:
+            split[:] = False
+        leaves.append((cells[~split], np.full(d, size), v[~split]))
+        if not split.any():
+            break
+        half = size // 2
+        cells = cells[split][:, None, :] + offsets[None] * half
+        cells = cells.reshape(-1, d)
+        size = half
+
+    scale = (hi - lo) / res
+    corners = np.concatenate([lo + c * scale for (c, _, _) in leaves])
+    sizes = np.concatenate([np.tile(s * scale, (len(c), 1))
+                            for (c, s, _) in leaves])
+    values = np.concatenate([v for (_, _, v) in leaves])
+    return Refinement(corners, sizes, values,
+                      queries = len(keys),
+                      dense_queries = (res + 1) ** d)
+
+def marching_squares(ref:Refinement, threshold:float = 0.5):
+    """Iso-contour of a 2D refinement as line segments (n x 2 x 2)
+
+    Each leaf crossing `threshold` contributes one segment, or two
+    for saddle cells (paired along the cell's corner cycle).
+    """
+    assert ref.corners.shape[1] == 2, 'marching squares needs a quadtree'
+    # product order (0,0) (0,1) (1,0) (1,1) -> cyclic order
+    cycle = [0, 1, 3, 2]
+    offsets = np.array([[0, 0], [0, 1], [1, 1], [1, 0]], dtype = np.float32)
+    v = ref.values[:, cycle]
+    inside = v > threshold
+    crossing = inside.any(axis = 1) & ~inside.all(axis = 1)
+    segments = []
+    for (c, s, vc) in zip(ref.corners[crossing], ref.sizes[crossing],
+                          v[crossing]):
+        points = []
+        for e in range(4):
+            a, b = e, (e + 1) % 4
+            if (vc[a] > threshold) == (vc[b] > threshold):
+                continue
+            w = (threshold - vc[a]) / (vc[b] - vc[a])
+            p = offsets[a] + w * (offsets[b] - offsets[a])
+            points.append(c + p * s)
+        for i in range(0, len(points) - 1, 2):
+            segments.append((points[i], points[i + 1]))
+    return np.array(segments, dtype = np.float32).reshape(-1, 2, 2)
@@ -8,6 +8,7 @@ from cusanus.utils.coordinates import (grids_along_depth,
                                        grids_along_axis,
                                        motion_grids,
                                        gfield_grids)
+from cusanus.utils.evaluation import LazyGrid, motion_grid, evaluate_field
 
 class RenderKFieldVolumes:
     def __init__(self,
@@ -17,8 +18,10 @@ class RenderKFieldVolumes:
                  xrange=(-3., 3.),
                  ny:int = 20,
                  yrange=(-3., 3.),
+                 budget_mib:float = 256.0,
                  ):
         super().__init__()
+        self.budget_mib = budget_mib
         self.nt = nt
         self.trange = trange
         self.nx = nx
@@ -28,34 +31,41 @@ class RenderKFieldVolumes:
 
     def on_validation_batch_end(self, trainer, exp, outputs, batch, batch_idx,
                                 data_loader_idx):
+        # ranks share batch indices, render the first shard only
+        if not trainer.is_global_zero:
+            return
         (qs, ys) = batch
-        fit_qs = qs[0].detach().cpu()
-        fit_ys = outputs['pred']
-        fig = plot_motion_trace(fit_qs, fit_ys)
-        path = os.path.join(exp.logger.log_dir, "volumes",
-                            f"batch_{batch_idx}.html")
-        fig.write_html(path)
+        for i in range(len(qs)):
+            fit_qs = qs[i].detach().cpu()
+            fit_ys = outputs['pred'][i]
+            fig = plot_motion_trace(fit_qs, fit_ys)
+            path = os.path.join(exp.logger.log_dir, "volumes",
+                                f"batch_{batch_idx}_{i}.html")
+            fig.write_html(path)
 
     def on_test_batch_end(self, trainer, exp, outputs, batch, batch_idx,
                                 data_loader_idx):
         (qs, ys) = batch
-        fit_qs = qs[0].detach().cpu()
-        fit_ys = outputs['pred']
-        m = outputs['mod']
-        pred_qs = motion_grids(self.nt, self.trange,
-                               self.nx, self.xrange,
-                               self.ny, self.yrange)
-        pred_qs = pred_qs.to(exp.device)
-        pred_ys = exp.eval_modulation(m, pred_qs).detach().cpu()
-        pred_qs = pred_qs.detach().cpu()
-        fig = plot_motion_trace(fit_qs, fit_ys)
-        path = os.path.join(exp.logger.log_dir, "test_volumes",
-                            f"batch_{batch_idx}_fit.html")
-        fig.write_html(path)
-        fig = plot_motion_volume(pred_qs, pred_ys)
-        path = os.path.join(exp.logger.log_dir, "test_volumes",
-                            f"batch_{batch_idx}_pred.html")
-        fig.write_html(path)
+        grid = motion_grid(self.nt, self.trange,
+                           self.nx, self.xrange,
+                           self.ny, self.yrange)
+        for i in range(len(qs)):
+            fit_qs = qs[i].detach().cpu()
+            fit_ys = outputs['pred'][i]
+            m = outputs['mod'][i]
+            # chunks hold whole frames
+            pred_ys, rate = evaluate_field(exp, m, grid,
+                                           budget_mib = self.budget_mib,
+                                           align = self.nx * self.ny)
+            exp.log('test_points_per_sec', rate, batch_size = 1)
+            fig = plot_motion_trace(fit_qs, fit_ys)
+            path = os.path.join(exp.logger.log_dir, "test_volumes",
+                                f"batch_{batch_idx}_{i}_fit.html")
+            fig.write_html(path)
+            fig = plot_motion_volume(grid, pred_ys)
+            path = os.path.join(exp.logger.log_dir, "test_volumes",
+                                f"batch_{batch_idx}_{i}_pred.html")
+            fig.write_html(path)
 
 
 
@@ -80,6 +90,28 @@ def plot_motion_trace(fit_qs, fit_ys):
 
     return fig
 
+def plot_motion_volume(grid:LazyGrid, values):
+    """One x-y heatmap per time of a `motion_grid`
+
+    Coordinates are taken from the grid axes, so the queries
+    themselves are never materialized.
+    """
+    (ts, xs, ys) = (a.cpu().numpy() for a in grid.axes)
+    volume = values.reshape(grid.shape)
+    (zmin, zmax) = (volume.min(), volume.max())
+    # heatmap rows run along y
+    heatmap = lambda k: go.Heatmap(x = xs, y = ys, z = volume[k].T,
+                                   zmin = zmin, zmax = zmax,
+                                   colorscale = 'Sunset')
+    fig = go.Figure(data = heatmap(0),
+                    frames = [go.Frame(data = heatmap(k),
+                                       name = f'{t:.2f}')
+                              for (k, t) in enumerate(ts)])
+    fig.update_layout(title = 'Predicted field over time',
+                      xaxis_title = 'X DIM',
+                      yaxis_title = 'Y DIM')
+    return add_frame_controls(fig, len(ts))
+
 def plot_3D_heatmap(qs:Tensor, ys:Tensor, t:int,
                     **plot_args):
 
@@ -106,6 +138,11 @@ def plot_3D_heatmap(qs:Tensor, ys:Tensor, t:int,
             type = 'heatmap',
             colorscale = 'Sunset'
         ))
+    fig.update_layout(title='Slices in volumetric data')
+    return add_frame_controls(fig, t)
+
+def add_frame_controls(fig, t:int):
+    """Adds a slider and play / pause buttons over `fig.frames`"""
 
     def frame_args(duration):
         return {
@@ -134,7 +171,6 @@ def plot_3D_heatmap(qs:Tensor, ys:Tensor, t:int,
 
     # Layout
     fig.update_layout(
-            title='Slices in volumetric data',
             width=600,
             height=600,
             updatemenus = [
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+""" CPU benchmark for event concept fitting.
+
+Random scenes with varying numbers of objects and sequences are
+bucketed and padded by `scene_loader` and trained on with
+`EventConcepts`, once per `block_tol`. Candidate pairs come from
+`event_pairs`.
+"""
+
+import time
+import argparse
+import numpy as np
+import torch
+
+from cusanus.archs.event_module import (EventModule, UpdateModule,
+                                        ModulatedMLP)
+from cusanus.datasets import event_pairs, scene_sizes, scene_loader
+from cusanus.tasks.event_concepts import EventConcepts
+
+def random_scene(rng, nobjects:int, nsequences:int, args):
+    """A scene in the format of `ragged_axes`"""
+    (n, s, k) = nobjects, nsequences, args.queries
+    pairs = event_pairs({}, n)['pairs']
+    return {'sequences' : {
+        'g' : rng.standard_normal((s, n, args.gsize), dtype = np.float32),
+        'k' : rng.standard_normal((s, n, args.ksize), dtype = np.float32),
+        't' : rng.random((s, n, 1), dtype = np.float32),
+        'pairs' : np.repeat(pairs[None], s, axis = 0),
+        'qs' : rng.standard_normal((s, n, k, 3), dtype = np.float32),
+        'ys' : rng.random((s, n, k, 1), dtype = np.float32),
+    }}
+
+def init_task(args, block_tol:float):
+    h = args.hidden
+    event_module = EventModule(
+        q_params = {'gsize' : args.gsize, 'ksize' : args.ksize,
+                    'hidden' : h},
+        c_params = {'q_in' : 2 * h, 'out' : 1, 'mod' : args.edim},
+        f_params = {'q_in' : 2 * h, 'out' : args.fdim,
+                    'mod' : args.edim + 2 * args.ddim})
+    update_module = UpdateModule(args.gsize, args.ksize, h,
+                                 args.fdim, args.ddim, {})
+    # stand-in for a trained kfield: (qs, kmod) -> likelihood
+    kfield = ModulatedMLP(3, 1, args.ksize, sigmoid = True)
+    return EventConcepts(event_module, update_module, kfield,
+                         e_dim = args.edim, d_dim = args.ddim,
+                         block_steps = args.block_steps,
+                         block_tol = block_tol)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Outer step throughput of event fitting',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--scenes', type = int, default = 32)
+    parser.add_argument('--batch_size', type = int, default = 4)
+    parser.add_argument('--max_objects', type = int, default = 6)
+    parser.add_argument('--max_sequences', type = int, default = 3)
+    parser.add_argument('--queries', type = int, default = 16)
+    parser.add_argument('--gsize', type = int, default = 8)
+    parser.add_argument('--ksize', type = int, default = 8)
+    parser.add_argument('--hidden', type = int, default = 32)
+    parser.add_argument('--edim', type = int, default = 8)
+    parser.add_argument('--ddim', type = int, default = 8)
+    parser.add_argument('--fdim', type = int, default = 8)
+    parser.add_argument('--block_steps', type = int, default = 3)
+    parser.add_argument('--block_tol', type = float, nargs = '+',
+                        default = [0.0, 0.01])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    scenes = [random_scene(rng,
+                           rng.integers(2, args.max_objects + 1),
+                           rng.integers(1, args.max_sequences + 1),
+                           args)
+              for _ in range(args.scenes)]
+    sizes = [tuple(scene_sizes(s).values()) for s in scenes]
+    loader = scene_loader(scenes, sizes, args.batch_size)
+
+    print('block_tol,steps/s,blocks,padded objects')
+    for tol in args.block_tol:
+        torch.manual_seed(0)
+        task = init_task(args, tol)
+        optimizer = task.configure_optimizers()[0][0]
+        blocks, padded = [], []
+        t0 = time.perf_counter()
+        for batch in loader:
+            optimizer.zero_grad()
+            loss, stats = task.meta_loss(batch)
+            loss.backward()
+            optimizer.step()
+            blocks.append(len(stats))
+            padded.append(1.0 - batch['masks']['objects'].float().mean())
+        dur = time.perf_counter() - t0
+        print(f'{tol},{len(loader) / dur:.2f},{np.mean(blocks):.2f},'
+              f'{np.mean(padded):.1%}')
+
+if __name__ == '__main__':
+    main()
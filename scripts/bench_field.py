@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+""" CPU benchmarks for field meta-learning.
+
+Each subcommand builds the gfield and kfield tasks from their
+configs and runs them on random batches of the right shape.
+"""
+
+import os
+import time
+import yaml
+import socket
+import resource
+import argparse
+import multiprocessing as mp
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from cusanus.archs import GModule, KModule, EModule, quantize_field
+from cusanus.tasks import GField, KField, EField
+from cusanus.tasks.inf import fit_modulation, eval_modulation, precisions
+from cusanus.utils.distributed import pin_threads
+
+fields = {
+    'gfield' : (GModule, GField),
+    'kfield' : (KModule, KField),
+    'efield' : (EModule, EField),
+}
+
+def load_config(name:str, kind:str):
+    with open(f"/project/scripts/configs/{name}_{kind}.yaml", 'r') as file:
+        return yaml.safe_load(file)
+
+def init_task(name:str, **task_params):
+    config = load_config(name, 'task')
+    arch, task = fields[name]
+    params = {**config['task_params'], **task_params}
+    arch_params = dict(config['arch_params'])
+    if name == 'kfield':
+        dconfig = load_config(name, 'dataset')
+        arch_params['k_per_frame'] = dconfig['kfield']['k_per_frame']
+    if name == 'efield':
+        # the kfield is only needed to extract codes
+        params.setdefault('kfield', None)
+    return task(arch(**arch_params), **params)
+
+def random_batch(name:str, batch_size:int = None):
+    config = load_config(name, 'task')
+    dconfig = load_config(name, 'dataset')
+    b = config['loader_params']['batch_size'] \
+        if batch_size is None else batch_size
+    if name == 'gfield':
+        k = dconfig['gfield']['k_inside'] + dconfig['gfield']['k_outside']
+        qs = torch.randn(b, k, 2)
+        ys = (torch.rand(b, k, 1) > 0.5).float()
+    elif name == 'kfield':
+        k = dconfig['kfield']['nframes'] * dconfig['kfield']['k_per_frame']
+        qs = torch.randn(b, k, 3)
+        ys = torch.rand(b, k, 1)
+    else:
+        arch = config['arch_params']
+        k = dconfig['dataset']['segment_frames']
+        qs = torch.randn(b, k, arch['mdim'] + arch['pdim'])
+        ys = torch.randn(b, k, arch['mdim'])
+    return qs, ys
+
+def steps_per_sec(task, batch, steps:int, warmup:int = 2):
+    """ Outer steps per second (meta-loss and backward) """
+    qs, ys = batch
+    for _ in range(warmup):
+        task.meta_loss(qs, ys)[0].backward()
+    task.zero_grad()
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        task.meta_loss(qs, ys)[0].backward()
+    return steps / (time.perf_counter() - t0)
+
+def _measure_child(conn, fn, args, kwargs):
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    dur = time.perf_counter() - t0
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        # ru_maxrss is in KiB on linux
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                - base) / 2**10
+    conn.send((result, peak, dur))
+    conn.close()
+
+def measure(fn, *args, **kwargs):
+    """ Runs `fn(*args, **kwargs)` in a fresh process
+
+    Returns the result, peak memory (MiB) above the process
+    baseline and wall time (s).
+    """
+    ctx = mp.get_context('fork')
+    parent, child = ctx.Pipe(duplex = False)
+    proc = ctx.Process(target = _measure_child,
+                       args = (child, fn, args, kwargs))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+def flat_grad(task):
+    return torch.cat([p.grad.reshape(-1) for p in task.parameters()
+                      if not p.grad is None])
+
+def meta_gradient(name:str, batch, **task_params):
+    torch.manual_seed(0)
+    task = init_task(name, **task_params)
+    objective, loss = task.meta_loss(*batch)
+    objective.backward()
+    return flat_grad(task), loss.item()
+
+def bench_compile(args):
+    print('field,mode,steps/sec')
+    for name in args.fields:
+        batch = random_batch(name, args.batch_size)
+        rates = {}
+        for mode in ['eager', 'compiled']:
+            torch.manual_seed(0)
+            task = init_task(name, compile_inner = mode == 'compiled')
+            rates[mode] = steps_per_sec(task, batch, args.steps)
+            print(f'{name},{mode},{rates[mode]:.3f}')
+        print(f'{name},speedup,{rates["compiled"] / rates["eager"]:.2f}x')
+
+def bench_metagrad(args):
+    print('field,mode,peak MiB,time s,loss,cosine to full,norm ratio')
+    for name in args.fields:
+        batch = random_batch(name, args.batch_size)
+        full = None
+        for mode in ['full', 'first_order', 'implicit']:
+            (g, loss), peak, dur = measure(meta_gradient, name, batch,
+                                           meta_grad = mode)
+            full = g if full is None else full
+            cos = torch.nn.functional.cosine_similarity(g, full, dim = 0)
+            ratio = torch.linalg.vector_norm(g) / \
+                torch.linalg.vector_norm(full)
+            print(f'{name},{mode},{peak:.1f},{dur:.2f},{loss:.5f},'
+                  f'{cos.item():.4f},{ratio.item():.4f}')
+
+def meta_step_time(name:str, batch, steps:int, **task_params):
+    torch.manual_seed(0)
+    task = init_task(name, **task_params)
+    return 1.0 / steps_per_sec(task, batch, steps, warmup = 1)
+
+def bench_checkpoint(args):
+    print('field,batch,checkpoint_steps,peak MiB,sec/step')
+    for name in args.fields:
+        config = load_config(name, 'task')
+        inner_steps = config['task_params']['inner_steps']
+        policies = [None, list(range(0, inner_steps, 2)), 'all']
+        base = config['loader_params']['batch_size'] \
+            if args.batch_size is None else args.batch_size
+        for b in [base, 2 * base]:
+            batch = random_batch(name, b)
+            for policy in policies:
+                dur, peak, _ = measure(meta_step_time, name, batch,
+                                       args.steps,
+                                       checkpoint_steps = policy)
+                label = str(policy).replace(',', ' ')
+                print(f'{name},{b},{label},{peak:.1f},{dur:.3f}')
+
+def meta_train(name:str, batch, steps:int, **task_params):
+    """ Runs `steps` outer updates on a fixed batch """
+    torch.manual_seed(0)
+    task = init_task(name, **task_params)
+    optimizer = task.configure_optimizers()[0][0]
+    for _ in range(steps):
+        optimizer.zero_grad()
+        task.meta_loss(*batch)[0].backward()
+        optimizer.step()
+    return task
+
+def loss_after(task, batch, inner_steps:int):
+    """ Mean prediction loss after `inner_steps` inner updates """
+    def fit_loss(qs, ys):
+        m = fit_modulation(task, qs, ys, inner_steps = inner_steps)
+        pred = eval_modulation(task, m, qs)
+        return task.pred_loss(qs, ys, pred)
+    with torch.enable_grad():
+        losses = torch.vmap(fit_loss)(*batch)
+    return losses.mean().item()
+
+def bench_inner_lr(args):
+    print('field,mode,inner steps,loss')
+    for name in args.fields:
+        config = load_config(name, 'task')
+        inner_steps = config['task_params']['inner_steps']
+        train = random_batch(name, args.batch_size)
+        held_out = random_batch(name, args.batch_size)
+        modes = {
+            'baseline' : {},
+            'meta_sgd' : {'learn_inner_lr' : True},
+            'meta_sgd_per_step' : {'learn_inner_lr' : True,
+                                   'per_step_lr' : True},
+        }
+        for mode, params in modes.items():
+            task = meta_train(name, train, args.steps, **params)
+            for k in range(1, inner_steps + 1):
+                loss = loss_after(task, held_out, k)
+                print(f'{name},{mode},{k},{loss:.5f}')
+
+def bench_precision(args):
+    print('field,precision,steps/sec,final loss')
+    for name in args.fields:
+        batch = random_batch(name, args.batch_size)
+        for precision in precisions:
+            torch.manual_seed(0)
+            task = init_task(name, precision = precision)
+            rate = steps_per_sec(task, batch, args.steps)
+            task = meta_train(name, batch, args.steps,
+                              precision = precision)
+            loss = task.meta_loss(*batch)[1].item()
+            print(f'{name},{precision},{rate:.3f},{loss:.5f}')
+
+def timed(fn, *args, repeats:int = 3):
+    """ Best wall time of `fn(*args)` and its result """
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+def fit_and_loss(task, batch):
+    qs, ys = batch
+    m, _ = task.fit_modulations(qs, ys)
+    (mfunc, mparams) = m
+    veval = torch.vmap(lambda p, q: eval_modulation(task, (mfunc, p), q))
+    pred = veval(mparams, qs)
+    return m, torch.vmap(task.pred_loss)(qs, ys, pred).mean().item()
+
+def bench_quantize(args):
+    print('field,weights,fit s,eval s,eval points/sec,loss')
+    for name in args.fields:
+        batch = random_batch(name, args.batch_size)
+        qs, _ = batch
+        torch.manual_seed(0)
+        task = init_task(name)
+        tasks = {'float32' : task, 'int8' : quantize_field(task)}
+        losses = {}
+        for weights, t in tasks.items():
+            fit_s, (m, losses[weights]) = timed(fit_and_loss, t, batch)
+            (mfunc, mparams) = m
+            veval = torch.vmap(
+                lambda p, q: eval_modulation(t, (mfunc, p), q))
+            with torch.no_grad():
+                eval_s, _ = timed(veval, mparams, qs)
+            print(f'{name},{weights},{fit_s:.3f},{eval_s:.4f},'
+                  f'{qs.shape[0] * qs.shape[1] / eval_s:.0f},'
+                  f'{losses[weights]:.5f}')
+        print(f'{name},loss delta,,,,'
+              f'{losses["int8"] - losses["float32"]:.5f}')
+
+class MetaLoss(torch.nn.Module):
+    """ Meta-objective as `forward`, so that DDP can wrap it """
+
+    def __init__(self, task):
+        super().__init__()
+        self.task = task
+
+    def forward(self, qs, ys):
+        return self.task.meta_loss(qs, ys)[0]
+
+def _ddp_rank(rank:int, nprocs:int, port:int, name:str, batch,
+              steps:int, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    threads = pin_threads(nprocs, rank)
+    dist.init_process_group('gloo', rank = rank, world_size = nprocs)
+    torch.manual_seed(0)
+    task = init_task(name)
+    model = DistributedDataParallel(
+        MetaLoss(task),
+        find_unused_parameters = task.ddp_find_unused_parameters)
+    optimizer = task.configure_optimizers()[0][0]
+    # the global batch is split across ranks
+    qs, ys = (x[rank::nprocs] for x in batch)
+
+    def step():
+        optimizer.zero_grad()
+        model(qs, ys).backward()
+        optimizer.step()
+
+    step()
+    dist.barrier()
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        step()
+    dist.barrier()
+    dur = time.perf_counter() - t0
+    if rank == 0:
+        results.put((threads, steps / dur))
+    dist.destroy_process_group()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def bench_ddp(args):
+    print('field,procs,threads/proc,steps/sec,speedup,efficiency')
+    ctx = torch.multiprocessing.get_context('spawn')
+    for name in args.fields:
+        batch = random_batch(name, args.batch_size)
+        base = None
+        for n in range(1, args.max_procs + 1):
+            results = ctx.SimpleQueue()
+            torch.multiprocessing.spawn(
+                _ddp_rank, nprocs = n,
+                args = (n, free_port(), name, batch, args.steps, results))
+            threads, rate = results.get()
+            base = rate if base is None else base
+            print(f'{name},{n},{threads},{rate:.3f},{rate / base:.2f}x,'
+                  f'{rate / base / n:.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmarks field meta-learning on CPU',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--fields', type = str, nargs = '+',
+                        default = ['gfield', 'kfield', 'efield'],
+                        help = 'Field configs to benchmark')
+    parser.add_argument('--batch_size', type = int, default = None,
+                        help = 'Meta-batch size (default: from config)')
+    parser.add_argument('--steps', type = int, default = 10,
+                        help = 'Timed outer steps')
+    parser.add_argument('--threads', type = int, default = None,
+                        help = 'Torch intra-op threads')
+    sub = parser.add_subparsers(dest = 'bench', required = True)
+    sub.add_parser('compile', help = 'Eager vs compiled inner loop')
+    sub.add_parser('metagrad', help = 'Memory and gradient agreement '
+                   'of meta-gradient modes')
+    sub.add_parser('checkpoint', help = 'Memory/time of inner step '
+                   'checkpointing')
+    sub.add_parser('inner_lr', help = 'Loss after each inner step with '
+                   'learned vs fixed inner rates')
+    sub.add_parser('quantize', help = 'Fit/eval latency and loss of '
+                   'int8 vs float32 weights')
+    sub.add_parser('precision', help = 'Throughput and loss of bfloat16 '
+                   'autocast vs float32')
+    ddp = sub.add_parser('ddp', help = 'Outer step throughput of gloo DDP '
+                         'from 1 to max_procs processes')
+    ddp.add_argument('--max_procs', type = int,
+                     default = max(len(os.sched_getaffinity(0)) // 4, 1),
+                     help = 'Largest number of processes')
+    args = parser.parse_args()
+    if not args.threads is None:
+        torch.set_num_threads(args.threads)
+
+    benches = {
+        'compile' : bench_compile,
+        'metagrad' : bench_metagrad,
+        'checkpoint' : bench_checkpoint,
+        'inner_lr' : bench_inner_lr,
+        'precision' : bench_precision,
+        'quantize' : bench_quantize,
+        'ddp' : bench_ddp,
+    }
+    benches[args.bench](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+""" CPU benchmarks for the JAX field engine.
+
+Each subcommand builds Equinox INRs shaped like the field configs
+and times them on random batches. Compare `engine` against
+`bench_field.py compile` for the torch tasks.
+"""
+
+import time
+import argparse
+import jax
+import jax.random as jr
+
+from cusanus.archs.siren import (ImplicitNeuralModule, ModulatedSirenNet,
+                                 StackedModulatedSirenNet, Modulator)
+from cusanus.tasks.jinf import JaxNeuralField
+
+# (q_in, out, mod, queries per trial) following the field configs
+shapes = {
+    'gfield' : (2, 1, 14, 2000),
+    'kfield' : (3, 1, 16, 150),
+    'efield' : (24, 16, 16, 30),
+}
+
+def init_inr(key, q_in:int, out:int, mod:int, depth:int = 8,
+             hidden:int = 64, w0_initial:float = 30.0, w0:float = 1.0,
+             c:float = 6.0, stacked:bool = False):
+    tkey, pkey = jr.split(key)
+    net = StackedModulatedSirenNet if stacked else ModulatedSirenNet
+    theta = net(tkey,
+                in_features = q_in,
+                hidden_features = hidden,
+                out_features = out,
+                num_layers = depth,
+                sine_weight = w0,
+                sine_weight_initial = w0_initial,
+                c = c)
+    psi = Modulator(pkey, mod, hidden, depth - 1)
+    return ImplicitNeuralModule(theta, psi)
+
+def random_batch(key, name:str, batch_size:int):
+    q_in, out, _, k = shapes[name]
+    qkey, ykey = jr.split(key)
+    qs = jr.normal(qkey, (batch_size, k, q_in))
+    ys = jr.uniform(ykey, (batch_size, k, out))
+    return qs, ys
+
+def time_steps(field, batch, steps:int):
+    """ Returns compile time (s) and outer steps per second """
+    t0 = time.perf_counter()
+    jax.block_until_ready(field.training_step(batch))
+    compile_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(steps):
+        loss = field.training_step(batch)
+    jax.block_until_ready(loss)
+    return compile_time, steps / (time.perf_counter() - t0)
+
+def bench_engine(args):
+    print('field,compile s,steps/sec')
+    for name in args.fields:
+        key = jr.PRNGKey(0)
+        q_in, out, mod, _ = shapes[name]
+        module = init_inr(key, q_in, out, mod, depth = args.depth)
+        field = JaxNeuralField(module)
+        batch = random_batch(key, name, args.batch_size)
+        compile_time, rate = time_steps(field, batch, args.steps)
+        print(f'{name},{compile_time:.2f},{rate:.3f}')
+
+def bench_stacked(args):
+    print('field,depth,layers,compile s,steps/sec')
+    for name in args.fields:
+        key = jr.PRNGKey(0)
+        q_in, out, mod, _ = shapes[name]
+        batch = random_batch(key, name, args.batch_size)
+        for depth in range(3, 17):
+            for stacked in [False, True]:
+                module = init_inr(key, q_in, out, mod, depth = depth,
+                                  stacked = stacked)
+                field = JaxNeuralField(module)
+                compile_time, rate = time_steps(field, batch, args.steps)
+                layers = 'stacked' if stacked else 'unrolled'
+                print(f'{name},{depth},{layers},{compile_time:.2f},'
+                      f'{rate:.3f}')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmarks the JAX field engine on CPU',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--fields', type = str, nargs = '+',
+                        default = list(shapes),
+                        help = 'Field shapes to benchmark')
+    parser.add_argument('--batch_size', type = int, default = 64,
+                        help = 'Meta-batch size')
+    parser.add_argument('--depth', type = int, default = 8,
+                        help = 'Siren depth')
+    parser.add_argument('--steps', type = int, default = 10,
+                        help = 'Timed outer steps')
+    sub = parser.add_subparsers(dest = 'bench', required = True)
+    sub.add_parser('engine', help = 'Compile time and throughput of '
+                   'the jitted outer step')
+    sub.add_parser('stacked', help = 'Unrolled vs scanned hidden layers '
+                   'for depths 3-16')
+    args = parser.parse_args()
+
+    benches = {
+        'engine' : bench_engine,
+        'stacked' : bench_stacked,
+    }
+    benches[args.bench](args)
+
+if __name__ == '__main__':
+    main()
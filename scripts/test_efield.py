@@ -3,6 +3,7 @@ import yaml
 import torch
 import argparse
 from pathlib import Path
+from ffcv.loader import OrderOption
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import CSVLogger
 from lightning_lite.utilities.seed import seed_everything
@@ -60,7 +61,10 @@ def main():
     # CONFIGURE FFCC DATA LOADERS
     dpath_test = f"/spaths/datasets/{dataset_name}_test_dataset.beton"
     device = runner.device_ids[0] if torch.cuda.is_available() else None
-    test_loader = KCodesDataset.load_ffcv(dpath_test, device, batch_size = 1)
+    # trials are fit in parallel across the batch
+    test_loader = KCodesDataset.load_ffcv(dpath_test, device,
+                                          order = OrderOption.SEQUENTIAL,
+                                          **config['loader_params'])
 
     # BEGIN TESTING
     Path(f"{logger.log_dir}/test_volumes").mkdir(exist_ok=True, parents=True)
@@ -3,6 +3,7 @@ import yaml
 import torch
 import argparse
 from pathlib import Path
+from ffcv.loader import OrderOption
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import CSVLogger
 from lightning_lite.utilities.seed import seed_everything
@@ -34,6 +35,8 @@ def main():
 
     with open(f"/project/scripts/configs/{task_name}_task.yaml", 'r') as file:
         config = yaml.safe_load(file)
+    with open(f"/project/scripts/configs/{dataset_name}_dataset.yaml", 'r') as file:
+        dconfig = yaml.safe_load(file)
 
     logger = CSVLogger(save_dir=config['logging_params']['save_dir'],
                        name= task_name,
@@ -57,7 +60,13 @@ def main():
     # CONFIGURE FFCC DATA LOADERS
     dpath_test = f"/spaths/datasets/{dataset_name}_test_dataset.beton"
     device = runner.device_ids[0] if torch.cuda.is_available() else None
-    test_loader = GFieldDataset.load_ffcv(dpath_test, device, batch_size = 1)
+    # occupancy is bit-packed; decoding needs the trial shapes
+    enum_shape = GFieldDataset(None, **dconfig['gfield']).enum_shape
+    # trials are fit in parallel across the batch
+    test_loader = GFieldDataset.load_ffcv(dpath_test, device,
+                                          enum_shape = enum_shape,
+                                          order = OrderOption.SEQUENTIAL,
+                                          **config['loader_params'])
 
     # BEGIN TESTING
     Path(f"{logger.log_dir}/test_volumes").mkdir(exist_ok=True, parents=True)
@@ -2,7 +2,9 @@ import os
 import yaml
 import torch
 import argparse
+from functools import partial
 from pathlib import Path
+from ffcv.loader import OrderOption
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import CSVLogger
 from lightning_lite.utilities.seed import seed_everything
@@ -11,7 +13,9 @@ from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 from cusanus.archs import GModule
 from cusanus.tasks import GField
 from cusanus.datasets import GFieldDataset
-from cusanus.utils import RenderGFieldVolumes
+from cusanus.utils import (RenderGFieldVolumes, ProfileMetaTraining,
+                           FFCVDataModule, cpu_ddp, pin_threads,
+                           shard_loader_params)
 
 
 task_name = 'gfield'
@@ -25,7 +29,19 @@ def main():
     parser.add_argument('--version', type = int,
                         help = 'Exp version number',
                         default = -1)
+    parser.add_argument('--profile', type = int,
+                        help = 'Report step profile every n steps (0 disables)',
+                        default = 0)
+    parser.add_argument('--trace_dir', type = str,
+                        help = 'Export torch profiler traces here',
+                        default = None)
+    parser.add_argument('--nprocs', type = int,
+                        help = 'Data-parallel CPU processes (gloo DDP)',
+                        default = 1)
     args = parser.parse_args()
+    if args.nprocs > 1:
+        # each rank (re-launched with LOCAL_RANK) takes its cores
+        pin_threads(args.nprocs)
     if args.version == -1:
         version = None
     else:
@@ -33,6 +49,8 @@ def main():
 
     with open(f"/project/scripts/configs/{task_name}_task.yaml", 'r') as file:
         config = yaml.safe_load(file)
+    with open(f"/project/scripts/configs/{dataset_name}_dataset.yaml", 'r') as file:
+        dconfig = yaml.safe_load(file)
 
     logger = CSVLogger(save_dir=config['logging_params']['save_dir'],
                        name= task_name,
@@ -45,37 +63,52 @@ def main():
     arch = GModule(**config['arch_params'])
     task = GField(arch, **config['task_params'])
 
+    profile = [ProfileMetaTraining(args.profile, args.trace_dir)] \
+        if args.profile > 0 else []
+
     runner = Trainer(logger=logger,
                      callbacks=[
                          LearningRateMonitor(),
                          ModelCheckpoint(save_top_k = 5,
                                          dirpath = os.path.join(logger.log_dir ,
                                                                 "checkpoints"),
-                                         monitor= "loss",
+                                         monitor= "train_loss",
                                          save_last=True),
                          RenderGFieldVolumes(),
+                         *profile,
 
                      ],
-                     accelerator = 'auto',
+                     **cpu_ddp(args.nprocs, task),
                      inference_mode = False,
                      **config['trainer_params'])
 
-    device = runner.device_ids[0] if torch.cuda.is_available() else None
+    device = runner.device_ids[0] \
+        if torch.cuda.is_available() and args.nprocs == 1 else None
 
     # CONFIGURE FFCC DATA LOADERS
+    # built by each rank once the process group exists
+    loader_params = shard_loader_params(config['loader_params'],
+                                        args.nprocs)
     dpath_train = f"/spaths/datasets/{dataset_name}_train_dataset.beton"
-    train_loader = GFieldDataset.load_ffcv(dpath_train, device,
-                                           **config['loader_params'])
+    # occupancy is bit-packed; decoding needs the trial shapes
+    enum_shape = GFieldDataset(None, **dconfig['gfield']).enum_shape
+    train_loader = partial(GFieldDataset.load_ffcv, dpath_train, device,
+                           enum_shape = enum_shape,
+                           **loader_params)
     dpath_val = f"/spaths/datasets/{dataset_name}_val_dataset.beton"
-    val_loader = GFieldDataset.load_ffcv(dpath_val, device,
-                                         batch_size = 1)
+    # sequential so that cached codes match trials across epochs
+    val_loader = partial(GFieldDataset.load_ffcv, dpath_val, device,
+                         enum_shape = enum_shape,
+                         order = OrderOption.SEQUENTIAL,
+                         batch_size = 1)
+    data = FFCVDataModule(train_loader, val_loader)
 
     # BEGIN TRAINING
     Path(f"{logger.log_dir}/volumes").mkdir(exist_ok=True, parents=True)
     print(f"======= Training {logger.name} =======")
     ckpt_path = Path(f'{logger.log_dir}/checkpoints/last.ckpt')
     ckpt_path = str(ckpt_path) if ckpt_path.exists() else None
-    runner.fit(task, train_loader, val_loader, ckpt_path=ckpt_path)
+    runner.fit(task, datamodule = data, ckpt_path=ckpt_path)
 
 if __name__ == '__main__':
     main()
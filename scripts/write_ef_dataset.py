@@ -16,9 +16,10 @@ from cusanus.tasks import KField
 
 name = 'efield'
 
-def load_kfield(config:dict, ckpt_path:str):
+def load_kfield(config:dict, ckpt_path:str, **hparams):
     arch = KModule(**config['arch_params'])
-    field = KField.load_from_checkpoint(ckpt_path, module = arch)
+    field = KField.load_from_checkpoint(ckpt_path, module = arch,
+                                        **hparams)
     return field
 
 def main():
@@ -43,14 +44,16 @@ def main():
 
     physics = config['physics']
     sim = config['simulations']
-    kfield = load_kfield(kconfig, efield['kfield_ckpt'])
+    kfield = load_kfield(kconfig, efield['kfield_ckpt'],
+                         **efield.get('kfield_fit', {}))
     device = 0 if torch.cuda.is_available() else None
     kfield = kfield.to(device)
 
     for dname in ['train', 'val', 'test']:
         c = config[dname]
         scenes = SceneDataset(**c, **physics)
-        simulations = SimDataset(scenes, **sim)
+        simulations = SimDataset(scenes, **sim,
+                                 contact_margin = efield.get('contact_margin'))
         d = KCodesDataset(simulations,
                           kfield,
                           **efield['dataset'],